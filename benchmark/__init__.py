@@ -0,0 +1,2 @@
+from benchmark import stubs
+stubs.install()
@@ -0,0 +1,150 @@
+"""Throughput benchmarks of reading, preparation and inversion runs on
+synthetic data.
+
+rapidinv is replaced by :py:func:`benchmark.synthetic.stub_run_rapidinv`
+and the GFDB by :py:class:`benchmark.synthetic.SyntheticGFDB`, so only the
+wrapper itself is measured. Results are appended as json lines to
+*results_file*, tagged with a label (default: the current git commit), to
+compare successive versions::
+
+    python -m benchmark.run_benchmark --sizes 100,1000 --ncpus 1,4
+    python -m benchmark.run_benchmark --compare
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import logging
+import argparse
+import subprocess
+from os.path import join as pjoin
+
+import rapidizer
+from rapidizer import RapidinvConfig, MultiEventInversion, FancyFilter
+from reader import Reader
+from wrapid_logging import setup_logger
+from benchmark.synthetic import SyntheticSetup, SyntheticGFDB, \
+    stub_run_rapidinv
+
+logger = logging.getLogger('wrapidinv')
+
+def git_label():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def make_filter():
+    magnitudes = [-1., 1, 2, 3, 4]
+    return FancyFilter(list(zip(magnitudes, [
+        (1.5, 2.5, 9.0, 12.0),
+        (1.0, 1.5, 8.0,  10.0),
+        (0.7, 1.2, 6.7,  7.5),
+        (0.5, 1.0, 6.0,  7.0),
+        (0.5, 1.0, 6.0,  7.0)])))
+
+class Benchmark():
+    def __init__(self, workdir, label, results_file):
+        self.workdir = workdir
+        self.label = label
+        self.results_file = results_file
+
+    def record(self, size, stage, ncpus, seconds, nitems):
+        result = {'label': self.label,
+                  'time': time.time(),
+                  'size': size,
+                  'stage': stage,
+                  'ncpus': ncpus,
+                  'seconds': seconds,
+                  'items_per_second': nitems/seconds if seconds > 0 else None}
+        print('%(size)6i events, %(stage)-15s ncpus %(ncpus)2i: %(seconds)8.2f s' % result)
+        with open(self.results_file, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+
+    def run(self, size, ncpus_list, nwaveforms=100):
+        setup = SyntheticSetup(pjoin(self.workdir, 'n%i' % size), nevents=size)
+        setup.make()
+        reader = Reader(setup.directory, data='data/*', events='events.pf',
+                        phases='phases.pf', need_traces=3)
+        t0 = time.time()
+        reader.start()
+        self.record(size, 'reader.start', 1, time.time()-t0, size)
+
+        events = reader.events[:nwaveforms]
+        t0 = time.time()
+        for e in events:
+            reader.get_waveforms(e, timespan=20.)
+        self.record(size, 'get_waveforms', 1, time.time()-t0, len(events))
+
+        gfdb = SyntheticGFDB()
+        for ncpus in ncpus_list:
+            config = RapidinvConfig(base_path=pjoin(setup.directory, 'inv'),
+                                    fn_stations=setup.fn_stations,
+                                    fn_defaults=setup.fn_defaults,
+                                    reset_time=True,
+                                    filter=make_filter())
+            inversion = MultiEventInversion(config=config, reader=reader,
+                                            left_shift=0.4, gfdb=gfdb)
+            t0 = time.time()
+            inversion.prepare(force=True, ncpus=ncpus)
+            self.record(size, 'prepare', ncpus, time.time()-t0, size)
+
+            t0 = time.time()
+            inversion.run_all(ncpus)
+            self.record(size, 'run_all', ncpus, time.time()-t0,
+                        len(inversion.inversions))
+            shutil.rmtree(config.base_path)
+
+def load_results(results_file):
+    results = []
+    if os.path.exists(results_file):
+        with open(results_file, 'r') as f:
+            for line in f:
+                results.append(json.loads(line))
+    return results
+
+def compare(results_file):
+    """Print the durations of each label relative to the previous label"""
+    results = load_results(results_file)
+    labels = []
+    latest = {}
+    for r in results:
+        if r['label'] not in labels:
+            labels.append(r['label'])
+        latest[(r['label'], r['size'], r['stage'], r['ncpus'])] = r['seconds']
+
+    for previous, label in zip(labels[:-1], labels[1:]):
+        print('%s -> %s' % (previous, label))
+        for (l, size, stage, ncpus), seconds in sorted(latest.items()):
+            if l != label or (previous, size, stage, ncpus) not in latest:
+                continue
+            before = latest[(previous, size, stage, ncpus)]
+            print('  %6i %-15s ncpus %2i: %8.2f s -> %8.2f s (%+.0f %%)' % (
+                size, stage, ncpus, before, seconds,
+                (seconds/before - 1.)*100. if before > 0 else 0.))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='comma separated numbers of events')
+    parser.add_argument('--ncpus', default='1,4,8',
+                        help='comma separated numbers of processes')
+    parser.add_argument('--workdir', default='benchmark_data')
+    parser.add_argument('--results', default='benchmark_results.jsonl')
+    parser.add_argument('--label', default=None)
+    parser.add_argument('--compare', action='store_true',
+                        help='compare stored results and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.results)
+        sys.exit(0)
+
+    setup_logger('wrapidinv', None, level=logging.WARNING)
+    rapidizer.run_rapidinv = stub_run_rapidinv
+    benchmark = Benchmark(args.workdir, args.label or git_label(),
+                          args.results)
+    for size in [int(x) for x in args.sizes.split(',')]:
+        benchmark.run(size, [int(x) for x in args.ncpus.split(',')])
@@ -0,0 +1,36 @@
+"""Stand-ins for the rapidinv and tunguska packages, which are only needed
+by the real inversions. Installed by :py:mod:`benchmark` if the packages
+cannot be imported, so that the wrapper can be benchmarked without them."""
+import sys
+import types
+
+class MinimizerError(Exception):
+    pass
+
+def run_rapidinv(args):
+    raise NotImplementedError('rapidinv is not installed; the benchmark '
+                              'replaces run_rapidinv by stub_run_rapidinv')
+
+class Gfdb(object):
+    def __init__(self, *args, **kwargs):
+        raise NotImplementedError('tunguska is not installed; use '
+                                  'benchmark.synthetic.SyntheticGFDB')
+
+def install():
+    try:
+        import rapidinv
+    except ImportError:
+        module = types.ModuleType('rapidinv')
+        module.run_rapidinv = run_rapidinv
+        module.MinimizerError = MinimizerError
+        sys.modules['rapidinv'] = module
+
+    try:
+        from tunguska import gfdb
+    except ImportError:
+        package = types.ModuleType('tunguska')
+        module = types.ModuleType('tunguska.gfdb')
+        module.Gfdb = Gfdb
+        package.gfdb = module
+        sys.modules['tunguska'] = package
+        sys.modules['tunguska.gfdb'] = module
@@ -0,0 +1,191 @@
+"""Synthetic catalogs, stations, phase markers and waveform archives."""
+import os
+import time
+import logging
+from os.path import join as pjoin
+import numpy as num
+from pyrocko import model, trace, io, gui_util, orthodrome
+
+from rapidizer import MyGFDB, read_rapidinv_input, RESULT_FILENAME
+
+logger = logging.getLogger('wrapidinv')
+
+class SyntheticSetup():
+    """Writes a self-contained test setup to *directory*.
+
+    :param nevents: number of events
+    :param nstations: number of three component stations
+    :param duration: time span covered by the catalog and the archive [s].
+                     Default: 10 s per event, as in a dense swarm.
+    :param deltat: sampling interval of the archive [s]
+    :param file_length: length of the MiniSEED files [s]
+    """
+    channels = ['SHZ', 'SHN', 'SHE']
+
+    def __init__(self, directory, nevents=100, nstations=8, duration=None,
+                 deltat=0.01, file_length=3600., lat=50.2, lon=12.4, seed=0):
+        self.directory = directory
+        self.nevents = nevents
+        self.nstations = nstations
+        self.duration = duration or nevents*10.
+        self.deltat = deltat
+        self.file_length = file_length
+        self.lat = lat
+        self.lon = lon
+        self.tmin = 1199145600.     # 2008-01-01
+        self.rstate = num.random.RandomState(seed)
+
+    @property
+    def fn_events(self):
+        return pjoin(self.directory, 'events.pf')
+
+    @property
+    def fn_stations(self):
+        return pjoin(self.directory, 'stations.pf')
+
+    @property
+    def fn_phases(self):
+        return pjoin(self.directory, 'phases.pf')
+
+    @property
+    def fn_defaults(self):
+        return pjoin(self.directory, 'rapidinv.defaults')
+
+    @property
+    def data_dir(self):
+        return pjoin(self.directory, 'data')
+
+    def make(self):
+        """Write all files, skipping those which exist already."""
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        t0 = time.time()
+        self.stations = self.make_stations()
+        self.events = self.make_events()
+        if not os.path.exists(self.fn_stations):
+            model.dump_stations(self.stations, self.fn_stations)
+        if not os.path.exists(self.fn_events):
+            model.dump_events(self.events, self.fn_events)
+        if not os.path.exists(self.fn_phases):
+            gui_util.save_markers(self.make_markers(), self.fn_phases)
+        if not os.path.exists(self.fn_defaults):
+            self.write_defaults()
+        if not os.path.exists(self.data_dir):
+            self.write_archive()
+        logger.info('synthetic setup in %s ready after %.1f s' % (
+            self.directory, time.time()-t0))
+
+    def make_stations(self):
+        stations = []
+        for i in range(self.nstations):
+            azi = 360.*i/self.nstations
+            dist = 5000. + 15000.*self.rstate.uniform()
+            lat, lon = orthodrome.ne_to_latlon(self.lat, self.lon,
+                                               dist*num.cos(num.radians(azi)),
+                                               dist*num.sin(num.radians(azi)))
+            stations.append(model.Station('', 'S%03i' % i, '', lat=float(lat),
+                                          lon=float(lon), elevation=0.))
+        return stations
+
+    def make_events(self):
+        times = num.sort(self.tmin + 60. + self.rstate.uniform(
+            0., self.duration-120., self.nevents))
+        events = []
+        for i, t in enumerate(times):
+            events.append(model.Event(
+                lat=self.lat + self.rstate.normal(0., 0.01),
+                lon=self.lon + self.rstate.normal(0., 0.01),
+                depth=8000. + self.rstate.normal(0., 500.),
+                time=float(t),
+                magnitude=float(self.rstate.uniform(0., 3.)),
+                name='ev%06i' % i))
+        return events
+
+    def make_markers(self):
+        markers = []
+        for e in self.events:
+            for s in self.stations:
+                t = e.time + orthodrome.distance_accurate50m(e, s)/6000.
+                m = gui_util.PhaseMarker([s.nsl() + ('SHZ',)], t, t,
+                                         kind=0, event=e, phasename='P')
+                markers.append(m)
+        return markers
+
+    def write_archive(self):
+        """One MiniSEED file per channel and *file_length* of noise with an
+        impulse at the P arrival of every event."""
+        nsamples = int(round(self.file_length/self.deltat))
+        tmax = self.tmin + self.duration
+        event_times = num.array([e.time for e in self.events])
+        for s in self.stations:
+            dists = num.array([orthodrome.distance_accurate50m(e, s)
+                               for e in self.events])
+            arrivals = event_times + dists/6000.
+            tfile = self.tmin
+            while tfile < tmax:
+                for cha in self.channels:
+                    ydata = self.rstate.normal(0., 1e-9, nsamples).astype(num.float32)
+                    isamples = ((arrivals-tfile)/self.deltat).astype(num.int64)
+                    isamples = isamples[(isamples>=0) & (isamples<nsamples)]
+                    ydata[isamples] += 1e-6
+                    tr = trace.Trace('', s.station, '', cha, tmin=tfile,
+                                     deltat=self.deltat, ydata=ydata)
+                    io.save([tr], pjoin(self.data_dir,
+                                        '%(station)s.%(channel)s.%(tmin)s.mseed'))
+                tfile += self.file_length
+
+    def write_defaults(self, **parameters):
+        defaults = {'GFDB_STEP1': pjoin(self.directory, 'gfdb'),
+                    'GFDB_STEP2': pjoin(self.directory, 'gfdb'),
+                    'GFDB_STEP3': pjoin(self.directory, 'gfdb'),
+                    'INVERSION_DIR': 'out',
+                    'DATA_DIR': 'data',
+                    'STRIKE_1': '0.', 'STRIKE_2': '350.', 'STRIKE_STEP': '10.',
+                    'DIP_1': '10.', 'DIP_2': '90.', 'DIP_STEP': '10.',
+                    'RAKE_1': '-180.', 'RAKE_2': '170.', 'RAKE_STEP': '10.'}
+        defaults.update(parameters)
+        with open(self.fn_defaults, 'w') as f:
+            for k in sorted(defaults.keys()):
+                f.write('%s   %s\n' % (k, defaults[k]))
+
+class SyntheticGFDB(MyGFDB):
+    """Stands in for a Green's function database with the given extent. No
+    database files are needed."""
+    def __init__(self, dt=0.05, firstx=1000., dx=500., nx=100, firstz=1000.,
+                 dz=500., nz=40):
+        self.config = None
+        self.gfdbpath = None
+        self.dt = dt
+        self.firstx = firstx
+        self.dx = dx
+        self.nx = nx
+        self.firstz = firstz
+        self.dz = dz
+        self.nz = nz
+        self.maxdist = self.firstx + self.dx*(self.nx-1)
+        self.maxdepth = self.firstz + self.dx*(self.nz-1)
+
+    def prefetch(self):
+        return 0
+
+def stub_run_rapidinv(args, seconds_per_trace=0.001):
+    """Replaces :py:func:`rapidinv.run_rapidinv`: reads the input, burns
+    cpu time proportional to the number of data files and writes a result
+    file with a misfit growing with the distance of the tested depths from
+    8 km."""
+    fn_input = args[0]
+    parameters = read_rapidinv_input(fn_input)
+    ntraces = len(os.listdir(parameters['DATA_DIR']))
+    t0 = time.time()
+    x = 0.
+    while time.time() - t0 < ntraces*seconds_per_trace:
+        x += num.sum(num.sqrt(num.arange(1000.)))
+
+    depth = 0.5*(float(parameters['DEPTH_1']) + float(parameters['DEPTH_2']))
+    with open(pjoin(parameters['INVERSION_DIR'], RESULT_FILENAME), 'w') as f:
+        f.write('MISFIT %g\n' % (0.2 + 0.05*abs(depth-8.)))
+        f.write('DEPTH %g\n' % depth)
+        f.write('STRIKE 30.\nDIP 60.\nRAKE -90.\n')
+        f.write('SCAL_MOM %s\n' % parameters.get('SCAL_MOM_1', '1e12'))
+        f.write('NTRACES %i\n' % ntraces)
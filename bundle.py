@@ -0,0 +1,98 @@
+"""Single file container for the traces of one inversion.
+
+Layout: 8 bytes magic, 8 bytes little endian header length, a json header
+and the samples of all traces as contiguous arrays, each aligned to
+:py:data:`ALIGN` bytes. The header holds the trace meta data with offsets
+into the file plus a free *meta* dict. :py:func:`load_bundle` maps the
+file and returns traces whose samples are views into the mapping.
+"""
+import os
+import json
+import struct
+import numpy as num
+from pyrocko import trace, io
+
+MAGIC = b'WRAPIDB1'
+ALIGN = 64
+
+def _aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def write_bundle(fn, traces, filenames=None, meta=None):
+    """Write *traces* to *fn*.
+
+    :param filenames: file names under which :py:func:`extract_bundle`
+        writes the traces, one per trace
+    :param meta: json serializable dict stored in the header
+    """
+    if filenames is None:
+        filenames = ['%s.%s.%s.%s' % tr.nslc_id for tr in traces]
+
+    arrays = [num.ascontiguousarray(tr.get_ydata()) for tr in traces]
+    entries = []
+    offset = 0
+    for tr, fn_trace, ydata in zip(traces, filenames, arrays):
+        entries.append({'nslc': list(tr.nslc_id),
+                        'tmin': tr.tmin,
+                        'deltat': tr.deltat,
+                        'dtype': ydata.dtype.str,
+                        'nsamples': ydata.size,
+                        'offset': offset,
+                        'filename': fn_trace})
+        offset = _aligned(offset + ydata.nbytes)
+
+    header = json.dumps({'traces': entries, 'meta': meta or {}}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    fn_tmp = fn + '.tmp'
+    with open(fn_tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for entry, ydata in zip(entries, arrays):
+            f.seek(data_start + entry['offset'])
+            f.write(ydata.tobytes())
+    os.rename(fn_tmp, fn)
+
+def read_header(fn):
+    with open(fn, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a trace bundle: %s' % fn)
+        nheader = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(nheader).decode('utf-8'))
+    header['data_start'] = _aligned(len(MAGIC) + 8 + nheader)
+    return header
+
+def load_bundle(fn):
+    """Load the traces of a bundle without copying the samples.
+
+    :returns: (traces, meta). The samples are read-only views into a
+        memory mapping of *fn*.
+    """
+    header = read_header(fn)
+    buf = num.memmap(fn, dtype=num.uint8, mode='r')
+    traces = []
+    for entry in header['traces']:
+        dtype = num.dtype(entry['dtype'])
+        istart = header['data_start'] + entry['offset']
+        ydata = buf[istart:istart+entry['nsamples']*dtype.itemsize].view(dtype)
+        network, station, location, channel = [str(x) for x in entry['nslc']]
+        traces.append(trace.Trace(network, station, location, channel,
+                                  tmin=entry['tmin'], deltat=entry['deltat'],
+                                  ydata=ydata))
+    return traces, header['meta']
+
+def extract_bundle(fn, directory):
+    """Write the traces of a bundle as individual MiniSEED files to
+    *directory*, as expected by rapidinv.
+
+    :returns: list of written file names
+    """
+    header = read_header(fn)
+    traces, meta = load_bundle(fn)
+    fns = []
+    for entry, tr in zip(header['traces'], traces):
+        fn_trace = os.path.join(directory, str(entry['filename']))
+        io.save(tr, fn_trace)
+        fns.append(fn_trace)
+    return fns
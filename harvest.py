@@ -0,0 +1,117 @@
+"""Consolidated results of all inversions of a catalog."""
+import os
+import csv
+import logging
+from collections import OrderedDict
+from pyrocko import model, moment_tensor
+
+logger = logging.getLogger('wrapidinv')
+
+class Harvester():
+    """Collects the best solutions of the inversions.
+
+    Every solution is appended as a row to the CSV table *fn_table* right
+    away. The events, with moment tensors where the solution has strike,
+    dip, rake and moment, are written to the pyrocko event file *fn_events*
+    by :py:meth:`save_events`. Existing files are continued. Rows carry the
+    hash of the inversion input; an event harvested again with another
+    hash replaces its row and event.
+    """
+    columns = ['key', 'time', 'lat', 'lon', 'catalog_depth', 'magnitude',
+               'misfit', 'depth', 'strike', 'dip', 'rake', 'moment',
+               'ntraces', 'input_hash']
+
+    def __init__(self, fn_table, fn_events):
+        self.fn_table = fn_table
+        self.fn_events = fn_events
+        self.rows = OrderedDict()
+        self.events = []
+        # tables of older versions lack columns and are rewritten
+        self._rewrite = False
+        if os.path.exists(fn_table):
+            with open(fn_table, 'r') as f:
+                reader = csv.DictReader(f)
+                for row in reader:
+                    self.rows[row['key']] = row
+                self._rewrite = reader.fieldnames != self.columns
+        if os.path.exists(fn_events):
+            self.events = model.load_events(fn_events)
+
+    def is_current(self, key, input_hash):
+        """True if the result of *key* was harvested from an inversion of
+        the input with hash *input_hash*"""
+        row = self.rows.get(key)
+        return row is not None and row.get('input_hash') == input_hash
+
+    def add(self, key, event, result, input_hash=''):
+        """Append the *result* dict (see :py:func:`rapidizer.read_result`)
+        of the inversion of *event*.
+
+        :param input_hash: hash of the inversion input
+        :returns: False if *key* has been harvested before with the same
+            *input_hash*"""
+        if self.is_current(key, input_hash):
+            return False
+
+        row = dict((k, result.get(k, '')) for k in self.columns)
+        row.update(key=key, time=event.time, lat=event.lat, lon=event.lon,
+                   catalog_depth=event.depth, magnitude=event.magnitude,
+                   input_hash=input_hash)
+        replace = key in self.rows
+        if replace:
+            logger.info('replacing result of %s' % key)
+            del self.rows[key]
+            self.events = [e for e in self.events if e.name != key]
+        self.rows[key] = row
+        if replace or self._rewrite:
+            self.save_table()
+        else:
+            new_file = not os.path.exists(self.fn_table)
+            with open(self.fn_table, 'a') as f:
+                writer = csv.DictWriter(f, fieldnames=self.columns,
+                                        extrasaction='ignore')
+                if new_file:
+                    writer.writeheader()
+                writer.writerow(row)
+
+        self.events.append(self.make_event(key, event, result))
+        return True
+
+    def save_table(self):
+        fn_tmp = self.fn_table + '.tmp'
+        with open(fn_tmp, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=self.columns,
+                                    extrasaction='ignore')
+            writer.writeheader()
+            for row in self.rows.values():
+                writer.writerow(row)
+        os.rename(fn_tmp, self.fn_table)
+        self._rewrite = False
+
+    @staticmethod
+    def make_event(key, event, result):
+        """pyrocko event at the location of *event* with the inverted depth
+        and mechanism of *result*"""
+        depth = event.depth
+        if 'depth' in result:
+            # rapidinv works in km
+            depth = float(result['depth'])*1000.
+        mt = None
+        magnitude = event.magnitude
+        try:
+            mt = moment_tensor.MomentTensor(
+                strike=float(result['strike']), dip=float(result['dip']),
+                rake=float(result['rake']),
+                scalar_moment=float(result['moment']))
+            magnitude = moment_tensor.moment_to_magnitude(
+                float(result['moment']))
+        except (KeyError, ValueError):
+            logger.debug('no mechanism in result of %s' % key)
+        return model.Event(lat=event.lat, lon=event.lon, time=event.time,
+                           depth=depth, magnitude=magnitude, name=key,
+                           moment_tensor=mt)
+
+    def save_events(self):
+        fn_tmp = self.fn_events + '.tmp'
+        model.dump_events(self.events, fn_tmp)
+        os.rename(fn_tmp, self.fn_events)
@@ -0,0 +1,100 @@
+import os
+import time
+import json
+import csv
+import logging
+from contextlib import contextmanager
+import numpy as num
+
+logger = logging.getLogger('wrapidinv')
+
+def cpu_time():
+    """user + system time of this process"""
+    t = os.times()
+    return t[0] + t[1]
+
+class Recorder():
+    """Collects timing records of processing stages.
+
+    Every record is a dict holding the *stage* name, a *key* identifying
+    the event, *wall* and *cpu* time in seconds and optional counters such
+    as *bytes* or *ntraces*."""
+    def __init__(self):
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, key=None, **counters):
+        """Context manager timing a stage. The record is yielded so that
+        counters can be added inside the block."""
+        record = dict(stage=name, key=key, **counters)
+        t0 = time.time()
+        c0 = cpu_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.time() - t0
+            record['cpu'] = cpu_time() - c0
+            self.records.append(record)
+
+    def add(self, name, key=None, wall=None, cpu=None, **counters):
+        record = dict(stage=name, key=key, wall=wall, cpu=cpu, **counters)
+        self.records.append(record)
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Per stage statistics: number of records, total, mean, percentiles
+        and maximum of wall and cpu time and the sums of the counters."""
+        by_stage = {}
+        for record in self.records:
+            by_stage.setdefault(record['stage'], []).append(record)
+
+        summary = {}
+        for stage, records in by_stage.items():
+            stats = {'count': len(records)}
+            for k in ['wall', 'cpu']:
+                values = num.array([r[k] for r in records if r.get(k) is not None],
+                                   dtype=num.float64)
+                if values.size == 0:
+                    continue
+                stats['%s_total' % k] = float(values.sum())
+                stats['%s_mean' % k] = float(values.mean())
+                stats['%s_max' % k] = float(values.max())
+                for p in percentiles:
+                    stats['%s_p%i' % (k, p)] = float(num.percentile(values, p))
+
+            counters = set(k for r in records for k in r.keys()) - \
+                set(['stage', 'key', 'wall', 'cpu'])
+            for k in counters:
+                values = [r[k] for r in records if isinstance(r.get(k), (int, float))]
+                if values:
+                    stats['%s_total' % k] = sum(values)
+            summary[stage] = stats
+
+        return summary
+
+    def dump_json(self, fn):
+        with open(fn, 'w') as f:
+            json.dump({'summary': self.summary(), 'records': self.records},
+                      f, indent=1, sort_keys=True)
+
+    def dump_csv(self, fn):
+        keys = ['stage', 'key', 'wall', 'cpu']
+        for record in self.records:
+            for k in sorted(record.keys()):
+                if k not in keys:
+                    keys.append(k)
+
+        with open(fn, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=keys)
+            writer.writeheader()
+            for record in self.records:
+                writer.writerow(record)
+
+    def log_summary(self):
+        for stage, stats in sorted(self.summary().items()):
+            logger.info('%s: %i x, wall %.2f s (p50 %.3f s, p90 %.3f s), cpu %.2f s' % (
+                stage, stats['count'], stats.get('wall_total', 0.),
+                stats.get('wall_p50', 0.), stats.get('wall_p90', 0.),
+                stats.get('cpu_total', 0.)))
@@ -1,12 +1,23 @@
 from os.path import join as pjoin
 import os
+import glob
 import shutil
 import logging
 import copy
+import time
+import traceback
+import pickle
+import json
+import re
+import hashlib
+import tempfile
+import select
+import signal
+import resource
 import numpy as num
 from scipy.interpolate import InterpolatedUnivariateSpline
-from collections import OrderedDict
-from multiprocessing import Process, Pool, Queue, JoinableQueue
+from collections import OrderedDict, deque
+from multiprocessing import Pool, Process
 from pyrocko.util import time_to_str
 from pyrocko import io
 from pyrocko import model
@@ -17,13 +28,42 @@ from pyrocko import moment_tensor
 from rapidinv import run_rapidinv, MinimizerError
 
 from tunguska import gfdb
+from instrumentation import Recorder, cpu_time
+from bundle import write_bundle, extract_bundle
+from taskqueue import TaskQueue, run_worker
+from writebehind import WriteBehind, WriteError
+from harvest import Harvester
 
 mkdir = os.mkdir
         
 logger = logging.getLogger('wrapidinv')
+
+BUNDLE_FILENAME = 'traces.bundle'
+# default summary of the best solution written by rapidinv into
+# INVERSION_DIR, see MultiEventInversion's result_filename
+RESULT_FILENAME = 'inv_result.dat'
+# default rapidinv parameter names of the summary and the harvested columns
+# they end up in; other parameters are kept under their lowercased names
+RESULT_KEYS = {'MISFIT': 'misfit',
+               'DEPTH': 'depth',
+               'STRIKE': 'strike',
+               'DIP': 'dip',
+               'RAKE': 'rake',
+               'SCAL_MOM': 'moment',
+               'MOMENT': 'moment',
+               'NTRACES': 'ntraces'}
+_result_line = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_]*)\s*[=:\s]\s*(\S.*)')
+
 class RapidinvDataError(Exception):
     pass
 
+class RapidinvResultError(Exception):
+    pass
+
+# MyGFDB instances by database path, shared within a process and inherited
+# by forked workers
+_gfdb_instances = {}
+
 class MyGFDB(gfdb.Gfdb):
     def __init__(self, *args, **kwargs):
         try:
@@ -31,17 +71,48 @@ class MyGFDB(gfdb.Gfdb):
         except KeyError:
             self.config = None
         gfdb.Gfdb.__init__(self, *args, **kwargs)
+        self.gfdbpath = kwargs.get('gfdbpath', args[0] if args else None)
         self.maxdist = self.firstx + self.dx*(self.nx-1)
         self.maxdepth = self.firstz + self.dx*(self.nz-1)
 
+    def prefetch(self, chunksize=16*1024*1024):
+        """Read the database files once, so that the rapidinv workers
+        started afterwards find them in the page cache instead of all
+        hitting the disk at the same time.
+
+        :returns: number of bytes read"""
+        nbytes = 0
+        for fn in sorted(glob.glob(self.gfdbpath + '*')):
+            if not os.path.isfile(fn):
+                continue
+            with open(fn, 'rb') as f:
+                while True:
+                    data = f.read(chunksize)
+                    if not data:
+                        break
+                    nbytes += len(data)
+        logger.info('prefetched %i bytes of gfdb %s' % (nbytes, self.gfdbpath))
+        return nbytes
+
     def out_of_bounds(self, event, station):
         dist = orthodrome.distance_accurate50m(event, station)
         return dist<self.firstx or dist>self.maxdist or event.depth<self.firstz or event.depth>self.maxdepth
 
+    def out_of_bounds_many(self, event, lats, lons):
+        """Vectorized :py:meth:`out_of_bounds` for stations at *lats*,
+        *lons*. Returns a boolean array."""
+        dists = orthodrome.distance_accurate50m_numpy(
+            num.ones(lats.size)*event.lat, num.ones(lons.size)*event.lon,
+            lats, lons)
+        if event.depth<self.firstz or event.depth>self.maxdepth:
+            return num.ones(lats.size, dtype=num.bool_)
+        return num.logical_or(dists<self.firstx, dists>self.maxdist)
+
     def adjust_sampling_rates(self, traces):
         """Equalize sampling rates of all traces according to gfdb"""
         for tr in traces:
-            tr.downsample_to(self.dt)
+            if abs(tr.deltat - self.dt) > 1e-6*self.dt:
+                tr.downsample_to(self.dt)
     
     def get_limits(self, in_km=False):
         if in_km is True:
@@ -51,38 +122,150 @@ class MyGFDB(gfdb.Gfdb):
 
     @classmethod
     def from_config(cls, config):
-        return cls(gfdbpath=config['GFDB_STEP1']+'/db', config=config)
+        """Return the database of *config*. Instances are opened once per
+        database path, so limits are computed only once. Since they are
+        shared between configs, they do not keep a reference to *config*."""
+        gfdbpath = config['GFDB_STEP1']+'/db'
+        if gfdbpath not in _gfdb_instances:
+            _gfdb_instances[gfdbpath] = cls(gfdbpath=gfdbpath)
+        return _gfdb_instances[gfdbpath]
+
+def directory_size(directory):
+    """Total size of the files below *directory* in bytes"""
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for fn in filenames:
+            size += os.path.getsize(pjoin(dirpath, fn))
+    return size
 
-def make_sane_directories(directory, force):
+def make_sane_directories(directory, force, keep=False):
+    """Create *directory*.
+
+    :param force: remove an existing directory first
+    :param keep: silently reuse an existing directory unless *force*"""
     if os.path.exists(directory):
         if force:
             shutil.rmtree(directory)
+        elif keep:
+            return
     mkdir(directory)
 
+class Manifest():
+    """Per-event bookkeeping of incremental runs, stored as json.
+
+    Every entry holds the *hash* of the inversion inputs and its *state*,
+    one of 'prepared', 'done' or 'failed'.
+
+    :py:meth:`save` appends the entries changed since the last save to a
+    journal next to the json file, one json line per entry, so that saving
+    after every event does not rewrite the whole manifest. The journal is
+    merged into the json file on load and by :py:meth:`compact`."""
+    def __init__(self, fn):
+        self.fn = fn
+        self.fn_journal = fn + '.journal'
+        self.entries = {}
+        self._changed = OrderedDict()
+        if os.path.exists(fn):
+            with open(fn, 'r') as f:
+                self.entries = json.load(f)
+        if os.path.exists(self.fn_journal):
+            with open(self.fn_journal, 'r') as f:
+                for line in f:
+                    try:
+                        key, entry = json.loads(line)
+                    except ValueError:
+                        # line cut short by a crash while saving
+                        logger.warning('skipping broken line of %s' %
+                                       self.fn_journal)
+                        continue
+                    if entry is None:
+                        self.entries.pop(key, None)
+                    else:
+                        self.entries[key] = entry
+            self.compact()
+
+    def get(self, key):
+        return self.entries.get(key, None)
+
+    def set(self, key, input_hash, state):
+        self.entries[key] = {'hash': input_hash, 'state': state}
+        self._changed[key] = True
+
+    def set_state(self, key, state, **info):
+        self.entries.setdefault(key, {'hash': None})
+        self.entries[key]['state'] = state
+        self.entries[key].update(info)
+        self._changed[key] = True
+
+    def remove(self, key):
+        if key in self.entries:
+            del self.entries[key]
+            self._changed[key] = True
+
+    def is_done(self, key, input_hash):
+        entry = self.get(key)
+        return entry is not None and entry['hash']==input_hash and \
+            entry['state']=='done'
+
+    def save(self):
+        """Append the changed entries to the journal."""
+        if not self._changed:
+            return
+        with open(self.fn_journal, 'a') as f:
+            for key in self._changed:
+                f.write(json.dumps([key, self.entries.get(key)]) + '\n')
+        self._changed.clear()
+
+    def compact(self):
+        """Write all entries to the json file and remove the journal."""
+        fn_tmp = self.fn + '.tmp'
+        with open(fn_tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.rename(fn_tmp, self.fn)
+        self._changed.clear()
+        if os.path.exists(self.fn_journal):
+            os.remove(self.fn_journal)
+
 class StationConfigurator():
     def __init__(self, fn_stations):
         self.fn_stations = fn_stations
         self.stations = model.load_stations(fn_stations)
+        self.make_index()
 
-    def make_rapidinv_stations_string(self, traces, event, gfdb):
-        stats = set([stat for tr in traces for stat in self.stations if
-                 util.match_nslc('%s.%s.%s.*'%stat.nsl(), tr.nslc_id )])
+    def make_index(self):
+        self._index = dict((s.nsl(), i) for i, s in enumerate(self.stations))
+        self._lats = num.array([s.lat for s in self.stations], dtype=num.float64)
+        self._lons = num.array([s.lon for s in self.stations], dtype=num.float64)
 
-        file_str = ''
+    def get_station_indices(self, traces):
+        """Sorted indices of the stations which recorded *traces*"""
+        nsls = set(tr.nslc_id[:3] for tr in traces)
+        return num.array(sorted(self._index[nsl] for nsl in nsls
+                                if nsl in self._index), dtype=num.int64)
+
+    def make_rapidinv_stations_string(self, traces, event, gfdb):
+        istations = self.get_station_indices(traces)
+        oob_mask = gfdb.out_of_bounds_many(event, self._lats[istations],
+                                           self._lons[istations])
+        lines = []
         oob = []
-        num_s = 0
-        for i,s in enumerate(stats):
-            if not gfdb.out_of_bounds(event, s):
-                file_str +='%s   '%(i+1)
-                num_s += 1
+        for i, (istation, is_oob) in enumerate(zip(istations, oob_mask)):
+            s = self.stations[istation]
+            if not is_oob:
+                lines.append('%s   %s   %s   %s\n' % (i+1, s.station, s.lat, s.lon))
             else:
-                oob.append(s.nsl)
-            file_str +='%s   '%s.station
-            file_str +='%s   %s\n'%(s.lat, s.lon)
-        return num_s, oob, file_str
+                oob.append(s.nsl())
+                lines.append('%s   %s   %s\n' % (s.station, s.lat, s.lon))
+        num_s = len(istations) - len(oob)
+        return num_s, oob, ''.join(lines)
 
 class FancyFilter():
-    def __init__(self, step1, step2=None, step3=None):
+    def __init__(self, step1, step2=None, step3=None, quantize=None):
+        '''
+        :param quantize: if set, magnitudes are rounded to multiples of
+        *quantize* before the corner frequencies are evaluated, so that a
+        small lookup table serves the whole catalog.
+        '''
         self.defaults = {}
         if not step2:
             step2 = step1
@@ -93,16 +276,58 @@ class FancyFilter():
         self.defaults['STEP1'] = step1
         self.defaults['STEP2'] = step2
         self.defaults['STEP3'] = step3
+        self.quantize = quantize
         
         self.interp = {}
         self.interpolate()
+        self._table = {}
 
     def set_filter(self, config, e):
         ''' set filter based on scalar moment. '''
         #mag = pyrocko.moment_tensor.moment_to_magnitude(config['SCAL_MOM_1']+(config['SCAL_MOM_2']-config['SCAL_MOM_1'])/2.)
-        mag = e.moment_tensor.magnitude if e.moment_tensor else e.magnitude
-        for k, interp in self.interp.items():
-            config.parameters[k] = interp(mag)
+        mag = self.get_magnitude(e)
+        if self.quantize:
+            mag = self.quantized(mag)
+        mag = float(mag)
+        if mag not in self._table:
+            self.precompute_magnitudes([mag])
+        for k, fc in self._table[mag].items():
+            config[k] = fc
+
+    @staticmethod
+    def get_magnitude(e):
+        return e.moment_tensor.magnitude if e.moment_tensor else e.magnitude
+
+    def quantized(self, mags):
+        return num.round(num.asarray(mags, dtype=num.float64)/self.quantize)*self.quantize
+
+    def corner_frequencies(self, mags):
+        '''Corner frequencies for an array of magnitudes.
+
+        :returns: dict of parameter name to array of corner frequencies'''
+        mags = num.asarray(mags, dtype=num.float64)
+        return dict((k, interp(mags)) for k, interp in self.interp.items())
+
+    def precompute_magnitudes(self, mags):
+        '''Fill the lookup table used by :py:meth:`set_filter` for *mags*
+        with one spline evaluation per corner frequency.'''
+        mags = num.unique(num.asarray(mags, dtype=num.float64))
+        for k, fcs in self.corner_frequencies(mags).items():
+            for mag, fc in zip(mags, fcs):
+                # 0-d arrays, formatted like single spline evaluations
+                self._table.setdefault(float(mag), {})[k] = num.asarray(fc)
+
+    def precompute(self, events):
+        '''Precompute the filter settings of all *events*.'''
+        mags = [self.get_magnitude(e) for e in events]
+        if self.quantize:
+            mags = self.quantized(mags)
+        self.precompute_magnitudes(mags)
+
+    def __deepcopy__(self, memo):
+        '''The filter does not change after construction and is shared by
+        copies of the config, instead of rebuilding the splines.'''
+        return self
 
     def interpolate(self):
         for step, settings in self.defaults.items(): 
@@ -130,6 +355,7 @@ class RapidinvConfig():
         self.reset_time = reset_time
         self.filter = filter
         self.parameters.update(**kwargs)
+        self._input_lines = None
 
     def load_defaults(self):
         defaults = OrderedDict()
@@ -169,15 +395,20 @@ class RapidinvConfig():
         Following wildcards can be used:
         GFDB_STEP*: sets the same gfdb directory for all 3 steps
         """
+        for k, v in self.substitute(key, value):
+            self.parameters[k] = v
+        self._input_lines = None
+
+    def substitute(self, key, value):
+        """Return list of (key, value) pairs to be set for *key*, see
+        :py:meth:`__setitem__`"""
         if key=='DATA_DIR':
             value = pjoin(self.base_path, value)
         if key=='INVERSION_DIR':
             value = pjoin(self.base_path, value)
         if key=='GFDB_STEP*':
-            for i in [1,2,3]:
-                self[key+i] = value
-            return 
-        self.parameters[key] = value
+            return [('GFDB_STEP%i' % i, value) for i in [1,2,3]]
+        return [(key, value)]
 
     def __getitem__(self, key):
         return self.parameters[key]
@@ -185,151 +416,1201 @@ class RapidinvConfig():
     def copy(self):
         return copy.deepcopy(self)
 
+    def overlay(self):
+        """Lightweight copy for event specific settings, see
+        :py:class:`ConfigOverlay`"""
+        return ConfigOverlay(self)
+
+    def get_input_lines(self):
+        """Cached OrderedDict of the formatted rapidinv input lines"""
+        if self._input_lines is None:
+            self._input_lines = OrderedDict(
+                (k, format_parameter(k, v)) for k, v in self.parameters.items())
+        return self._input_lines
+
     def make_rapidinv_input(self):
-        string = ''
-        for k,v in self.parameters.items():
-            if isinstance(v, float):
-                string+='{0:25s} {1:f}\n'.format(k, v)
-            else:
-                string+='{0:25s} {1:s}\n'.format(k, v)
-        return string
+        return ''.join(self.get_input_lines().values())
 
     def set_filter(self, event):
         self.filter.set_filter(self, event)
-        
 
-def worker(tasks, num_tasks):
-    i = 0
-    for task in iter(tasks.get, 'stop'):
-        i+=1
-        logger.info('get task %s: %s'%(i, task))
+def format_parameter(k, v):
+    """Format a single line of the rapidinv input file"""
+    if isinstance(v, float):
+        return '{0:25s} {1:f}\n'.format(k, v)
+    else:
+        return '{0:25s} {1:s}\n'.format(k, str(v))
+
+class ConfigOverlay():
+    """Event specific settings on top of a shared :py:class:`RapidinvConfig`.
+
+    Only overridden parameters are stored, everything else is looked up in
+    the base config. Parameters appended by the overlay are written after
+    those of the base config, just as in a copy of the base config."""
+    def __init__(self, base):
+        self.base = base
+        self.parameters = OrderedDict()
+
+    @property
+    def base_path(self):
+        return self.base.base_path
+
+    @property
+    def reset_time(self):
+        return self.base.reset_time
+
+    @property
+    def test_depths(self):
+        return self.base.test_depths
+
+    @property
+    def stations(self):
+        return self.base.stations
+
+    @property
+    def filter(self):
+        return self.base.filter
+
+    def get_depths(self, event):
+        return self.base.get_depths(event)
+
+    def make_rapidinv_stations_string(self, *args, **kwargs):
+        return self.base.make_rapidinv_stations_string(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        for k, v in self.base.substitute(key, value):
+            self.parameters[k] = v
+
+    def __getitem__(self, key):
+        try:
+            return self.parameters[key]
+        except KeyError:
+            return self.base[key]
+
+    def items(self):
+        """Merged (key, value) pairs in input file order"""
+        items = [(k, self.parameters.get(k, v))
+                 for k, v in self.base.parameters.items()]
+        items.extend((k, v) for k, v in self.parameters.items()
+                     if k not in self.base.parameters)
+        return items
+
+    def get_rapidinv_config(self):
+        return ''.join('%s   %s\n'%(k,v) for k, v in self.items())
+
+    def make_rapidinv_input(self):
+        lines = self.base.get_input_lines()
+        out = [format_parameter(k, self.parameters[k]) if k in self.parameters
+               else line for k, line in lines.items()]
+        out.extend(format_parameter(k, v) for k, v in self.parameters.items()
+                   if k not in lines)
+        return ''.join(out)
+
+    def set_filter(self, event):
+        self.filter.set_filter(self, event)
+
+    def copy(self):
+        overlay = ConfigOverlay(self.base)
+        overlay.parameters = self.parameters.copy()
+        return overlay
+
+    def __getstate__(self):
+        """The base config is not pickled, it has to be reattached."""
+        state = self.__dict__.copy()
+        state['base'] = None
+        return state
+
+class CostModel():
+    """Predicts the run time of inversions from their cost estimate and
+    the run times recorded in previous runs, stored as json in *fn*.
+
+    Inversions which ran before are predicted by their last run time,
+    others by their estimate scaled with the median ratio of run time to
+    estimate of all recorded inversions."""
+    def __init__(self, fn):
+        self.fn = fn
+        self.entries = {}
+        if os.path.exists(fn):
+            with open(fn, 'r') as f:
+                self.entries = json.load(f)
+
+    def add(self, key, estimate, duration, lower_bound=False):
+        """:param lower_bound: the run was aborted after *duration*, keep a
+        longer duration recorded before"""
+        if lower_bound and key in self.entries:
+            duration = max(duration, self.entries[key]['duration'])
+        self.entries[key] = {'estimate': estimate, 'duration': duration}
+
+    def get_scale(self):
+        ratios = [v['duration']/v['estimate'] for v in self.entries.values()
+                  if v['estimate']]
+        if not ratios:
+            return 1.
+        return float(num.median(ratios))
+
+    def predict(self, inversions):
+        """Predicted run times of *inversions*"""
+        scale = self.get_scale()
+        predictions = []
+        for inversion in inversions:
+            if inversion.key in self.entries:
+                predictions.append(self.entries[inversion.key]['duration'])
+            else:
+                predictions.append(inversion.estimate_cost()*scale)
+        return predictions
+
+    def save(self):
+        fn_tmp = self.fn + '.tmp'
+        with open(fn_tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.rename(fn_tmp, self.fn)
+
+class TaskResult():
+    """Outcome of a single :py:func:`run_rapidinv` call.
+
+    :param args: arguments the task was called with
+    :param status: 'ok', 'minimizer_error', 'timeout', 'oom' or 'error'
+    :param duration: wall clock time in seconds
+    :param exception: exception raised by the task, if any
+    :param cpu: cpu time in seconds
+    :param attempts: number of runs, including retries
+    """
+    def __init__(self, args, status, duration, exception=None, traceback=None,
+                 cpu=None, attempts=1):
+        self.args = args
+        self.status = status
+        self.duration = duration
+        self.cpu = cpu
+        self.exception = exception
+        self.traceback = traceback
+        self.attempts = attempts
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+    def __str__(self):
+        return '%s: %s after %.1f s' % (self.args[0], self.status,
+                                        self.duration)
+
+    def to_dict(self):
+        """json serializable form, the exception is kept as string"""
+        return {'args': list(self.args),
+                'status': self.status,
+                'duration': self.duration,
+                'cpu': self.cpu,
+                'exception': None if self.exception is None else str(
+                    self.exception),
+                'traceback': self.traceback,
+                'attempts': self.attempts}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(tuple(d['args']), d['status'], d['duration'],
+                   exception=None if d['exception'] is None else Exception(
+                       d['exception']),
+                   traceback=d['traceback'], cpu=d['cpu'],
+                   attempts=d['attempts'])
+
+def _picklable(exception):
+    """Exceptions have to travel back to the parent process."""
+    try:
+        pickle.loads(pickle.dumps(exception))
+        return exception
+    except Exception:
+        return Exception(repr(exception))
+
+def read_result(directory, filename=RESULT_FILENAME, keys=None):
+    """Best solution of a finished rapidinv run in *directory*.
+
+    Reads the parameter lines of the summary file *filename*, written like
+    the rapidinv input as ``NAME value`` (``NAME = value`` and
+    ``NAME: value`` are accepted as well). rapidinv appends the solution of
+    each inversion step, so later lines win.
+
+    :param keys: dict translating parameter names to result keys (default
+        :py:data:`RESULT_KEYS`)
+    :returns: dict of strings or None if there is no summary file
+    """
+    if keys is None:
+        keys = RESULT_KEYS
+    fn = pjoin(directory, filename)
+    if not os.path.exists(fn):
+        return None
+    result = {}
+    with open(fn, 'r') as f:
+        for line in f:
+            m = _result_line.match(line.split('#', 1)[0])
+            if m:
+                k = m.group(1).upper()
+                result[keys.get(k, k.lower())] = m.group(2).strip()
+    return result
+
+def _read_result_task(args):
+    return read_result(*args)
+
+def read_rapidinv_input(fn):
+    """Parameters of a rapidinv input file as dict of strings"""
+    parameters = {}
+    with open(fn, 'r') as f:
+        for line in f:
+            k, v = line.split(None, 1)
+            parameters[k] = v.strip()
+    return parameters
+
+def write_input_copy(fn_input, fn_copy, overrides):
+    """Copy the rapidinv input file *fn_input* to *fn_copy*, replacing the
+    parameters in *overrides*."""
+    with open(fn_input, 'r') as f:
+        lines = f.readlines()
+    with open(fn_copy, 'w') as f:
+        for line in lines:
+            k = line.split(None, 1)[0]
+            if k in overrides:
+                line = format_parameter(k, overrides[k])
+            f.write(line)
+
+def unpack_data(args):
+    """Extract the trace bundle of an inversion into a private scratch
+    directory (below TMPDIR).
+
+    The other files of the data directory are copied along and the
+    rapidinv input file is copied with DATA_DIR pointing to the scratch
+    directory. Parts of an event split by depth thus never share extracted
+    files, and the shared data directory only holds the bundle.
+
+    :returns: (args, scratch directory) to run rapidinv with. If there is
+        no bundle, *args* unchanged and None.
+    """
+    fn_input = args[0]
+    data_dir = read_rapidinv_input(fn_input)['DATA_DIR']
+    fn_bundle = pjoin(data_dir, BUNDLE_FILENAME)
+    if not os.path.exists(fn_bundle):
+        return args, None
+
+    scratch = tempfile.mkdtemp(prefix='wrapidinv_')
+    try:
+        for fn in os.listdir(data_dir):
+            if fn != BUNDLE_FILENAME and os.path.isfile(pjoin(data_dir, fn)):
+                shutil.copy(pjoin(data_dir, fn), pjoin(scratch, fn))
+        extract_bundle(fn_bundle, scratch)
+        fn_copy = pjoin(scratch, os.path.basename(fn_input))
+        write_input_copy(fn_input, fn_copy, {'DATA_DIR': scratch})
+    except Exception:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+    return (fn_copy,) + tuple(args[1:]), scratch
+
+def run_task(args):
+    """Run rapidinv and report the outcome as :py:class:`TaskResult`
+    instead of raising."""
+    t0 = time.time()
+    c0 = cpu_time()
+    scratch = None
+    try:
+        run_args, scratch = unpack_data(args)
+        run_rapidinv(run_args)
+    except MinimizerError as e:
+        result = TaskResult(args, 'minimizer_error', time.time()-t0,
+                            _picklable(e))
+    except MemoryError as e:
+        result = TaskResult(args, 'oom', time.time()-t0, _picklable(e))
+    except Exception as e:
+        result = TaskResult(args, 'error', time.time()-t0, _picklable(e),
+                            traceback.format_exc())
+    else:
+        result = TaskResult(args, 'ok', time.time()-t0)
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    result.cpu = cpu_time()-c0
+    return result
+
+def write_retry_input(fn_input, overrides, attempt):
+    """Copy of the rapidinv input file *fn_input* with the parameters in
+    *overrides* replaced.
+
+    :returns: file name of the copy"""
+    fn_retry = '%s_retry%i.inp' % (os.path.splitext(fn_input)[0], attempt)
+    write_input_copy(fn_input, fn_retry, overrides)
+    return fn_retry
+
+class TaskPolicy():
+    """Runs rapidinv tasks under resource limits, with retries.
+
+    If a *timeout* or *memory_limit* is set, every attempt runs in a forked
+    child process in its own process group, which is killed when the
+    timeout expires. Without limits tasks run directly as in
+    :py:func:`run_task`.
+
+    :param timeout: wall clock limit per attempt in seconds
+    :param memory_limit: address space limit per attempt in bytes
+    :param retries: number of retries after a failed attempt
+    :param retry_overrides: list of dicts of rapidinv parameters replaced in
+        the input file of the n-th retry, e.g. a different starting point or
+        a coarser grid. The last dict is used for further retries.
+    :param retry_on: statuses which trigger a retry
+    """
+    def __init__(self, timeout=None, memory_limit=None, retries=0,
+                 retry_overrides=None, retry_on=('timeout', 'oom',
+                                                 'minimizer_error')):
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.retries = retries
+        self.retry_overrides = retry_overrides or []
+        self.retry_on = retry_on
+
+    @property
+    def supervised(self):
+        return self.timeout is not None or self.memory_limit is not None
+
+    def __call__(self, args):
+        t0 = time.time()
+        cpu = 0.
+        attempt_args = args
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                logger.info('retry %i of %s after %s' % (attempt, args[0],
+                                                        result.status))
+                if self.retry_overrides:
+                    overrides = self.retry_overrides[
+                        min(attempt, len(self.retry_overrides)) - 1]
+                    attempt_args = (write_retry_input(args[0], overrides,
+                                                      attempt),) + \
+                        tuple(args[1:])
+
+            if self.supervised:
+                result = self.run_child(attempt_args)
+            else:
+                result = run_task(attempt_args)
+            cpu += result.cpu or 0.
+            if result.status not in self.retry_on:
+                break
+
+        result.args = args
+        result.duration = time.time() - t0
+        result.cpu = cpu
+        result.attempts = attempt + 1
+        return result
+
+    def run_child(self, args):
+        """Run a single attempt in a forked child process."""
+        t0 = time.time()
+        fd_read, fd_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(fd_read)
+            status = 1
+            try:
+                os.setpgid(0, 0)
+                if self.memory_limit is not None:
+                    resource.setrlimit(resource.RLIMIT_AS,
+                                       (self.memory_limit, self.memory_limit))
+                result = run_task(args)
+                data = pickle.dumps(result, 2)
+                while data:
+                    data = data[os.write(fd_write, data):]
+                status = 0
+            finally:
+                os._exit(status)
+
+        os.close(fd_write)
+        chunks = []
+        timed_out = False
+        try:
+            while True:
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.time() - t0)
+                    if remaining <= 0.:
+                        timed_out = True
+                        break
+                    ready = select.select([fd_read], [], [], remaining)[0]
+                    if not ready:
+                        continue
+                chunk = os.read(fd_read, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(fd_read)
+            if timed_out:
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            wait_status = os.waitpid(pid, 0)[1]
+
+        if timed_out:
+            return TaskResult(args, 'timeout', time.time()-t0,
+                              Exception('killed after %g s' % self.timeout))
         try:
-            thread = Process(target=run_rapidinv, args=(task,))
-            logger.info('start thread %s'%thread.name) 
-            #thread.deamon = True
-            thread.deamon = False
-            thread.start()
-            
-            thread.join()
-            thread.terminate()
-            logger.info('terminated %s'%thread.name) 
-        except MinimizerError:
-            logger.info('WARNING: got MinimizerError in thread %s' %thread.name)
-            continue
-    return True
+            return pickle.loads(b''.join(chunks))
+        except Exception:
+            # killed without reporting, typically by the kernel when out
+            # of memory
+            if os.WIFSIGNALED(wait_status) and \
+                    os.WTERMSIG(wait_status) == signal.SIGKILL:
+                status = 'oom'
+            else:
+                status = 'error'
+            return TaskResult(args, status, time.time()-t0, Exception(
+                'worker died with status %i' % wait_status))
+
+def queue_worker(queue_dir, policy=None, stale_after=300., **kwargs):
+    """Run inversions published by :py:meth:`MultiEventInversion.run_distributed`.
+
+    :param policy: :py:class:`TaskPolicy` (default: no limits). Retries and
+        retry overrides published with a task replace those of the policy.
+    :param kwargs: passed to :py:func:`taskqueue.run_worker`
+    """
+    def run(payload):
+        func = policy or run_task
+        if 'retries' in payload:
+            func = copy.copy(policy or TaskPolicy())
+            func.retries = payload['retries']
+            func.retry_overrides = payload['retry_overrides']
+        return func(tuple(payload['args'])).to_dict()
+
+    return run_worker(TaskQueue(queue_dir, stale_after=stale_after), run,
+                      **kwargs)
+
+# MultiEventInversion instance used by forked prepare workers
+_prepare_context = None
+
+def _prepare_task(multi_inversion, task):
+    i, e, traces, kwargs = task
+    return i, multi_inversion.prepare_event(i, e, traces=traces, **kwargs)
+
+def _prepare_worker(task):
+    i, inversion = _prepare_task(_prepare_context, task)
+    # the writer threads of this process have to finish before the
+    # inversion is handed to the parent
+    if inversion is not None and _prepare_context.get_writer() is not None \
+            and not _prepare_context.wait_written(inversion):
+        inversion = None
+    return i, inversion
+
+def _imap_bounded(pool, func, tasks, max_pending):
+    """Like Pool.imap but does not consume more than *max_pending* tasks
+    ahead of the results."""
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
 
 class MultiEventInversion():
-    def __init__(self, config, reader, blacklist=None, left_shift=None):
+    def __init__(self, config, reader, blacklist=None, left_shift=None,
+                 preselect_stations=False, timespan=20., share_gfdb=False,
+                 gfdb=None, bundle=False, writer_threads=0, fsync=False,
+                 result_filename=RESULT_FILENAME, result_keys=None):
+        """
+        :param timespan: length of the data time windows [s]
+        :param gfdb: :py:class:`MyGFDB` instance to be used instead of the
+        database configured by GFDB_STEP1
+        :param bundle: write the traces of each event into a single file
+        (see :py:mod:`bundle`) instead of one MiniSEED file per trace. The
+        bundle is extracted into a scratch directory by the worker for the
+        duration of each rapidinv run, see :py:func:`unpack_data`.
+        :param share_gfdb: read the GFDB into the page cache before any
+        workers are started, see :py:meth:`MyGFDB.prefetch`
+        :param preselect_stations: only retrieve waveforms of stations
+        within the distance range of the GFDB (default False). Traces of
+        other stations are then neither written as OOB nor counted for the
+        reader's *need_traces*.
+        :param writer_threads: write the files of prepared inversions in
+        that many background threads (see :py:mod:`writebehind`) while the
+        next events are prepared. 0 (default) writes synchronously.
+        :param fsync: with *writer_threads*, fsync the written files before
+        an inversion is handed on for running
+        :param result_filename: summary file rapidinv writes into
+        INVERSION_DIR, see :py:func:`read_result`. A successful run without
+        it raises :py:exc:`RapidinvResultError`.
+        :param result_keys: dict translating the parameter names of the
+        summary to the harvested columns (default :py:data:`RESULT_KEYS`)
+        """
         self.left_shift = left_shift
+        self.writer_threads = writer_threads
+        self.fsync = fsync
+        self.result_filename = result_filename
+        self.result_keys = result_keys or RESULT_KEYS
+        self._writer = None
+        self._writer_pid = None
+        self.timespan = timespan
+        self.bundle = bundle
         self.blacklist = blacklist or []
         self.config = config
         self.reader = reader
-        self.gfdb = MyGFDB.from_config(config)
+        self.gfdb = gfdb or MyGFDB.from_config(config)
+        if share_gfdb:
+            self.gfdb.prefetch()
+        if preselect_stations:
+            self.reader.set_station_selection(self.config.stations.stations,
+                                              self.gfdb.firstx,
+                                              self.gfdb.maxdist)
         self.inversions = []
+        self.manifest = None
+        self.recorder = Recorder()
+        self.cost_model = None
+        self.harvester = None
 
-    def prepare(self, force=False, num_inversions=99999999, try_set_sdr=False):
+    def prepare(self, force=False, num_inversions=99999999, try_set_sdr=False,
+                ncpus=1, incremental=False, batch=False, memory_budget=500e6,
+                depth_splits=1):
         """ Prepare inversions.
 
         :param force: (default False) force overwrite of existing directory
-        :param num_inversions: number of inversions to be done
+        :param num_inversions: stop after that many events are prepared
         :param try_set_sdr: if the underlying event contains MT information, use
         those in the rapidinv input file (default False). Mostly for debugging
         and testing.
+        :param ncpus: number of processes preparing events in parallel
+        (default 1). Results are collected in catalog order, hence
+        *self.inversions* and the *num_inversions* cutoff do not depend on
+        *ncpus*.
+        :param incremental: keep the existing *base_path* and only
+        re-prepare events whose inputs changed since the last run, see
+        :py:meth:`start_manifest`. Takes precedence over *force*.
+        :param batch: retrieve waveforms with
+        :py:meth:`Reader.get_waveforms_batch` in a single pass over the pile.
+        Events are then prepared in chronological order, which also applies
+        to the *num_inversions* cutoff.
+        :param memory_budget: approximate limit of waveform data loaded at
+        once in *batch* mode [bytes]
+        :param depth_splits: split the depth grid of each event into that
+        many sub-ranges, inverted as separate tasks which share the data of
+        the event. The best fitting depth is collected by
+        :py:meth:`merge_depths`.
         """
         logger.debug('preparing, force=%s'%force)
-        make_sane_directories(self.config.base_path, force)
-        for i, e in enumerate(self.reader.iter_events()):
-            if self.out_path(e) in self.blacklist:
-                continue
-            local_config = self.config.copy()
-            local_config['INVERSION_DIR'] = pjoin(self.out_path(e), 'out')
-            local_config['DATA_DIR'] = pjoin(self.out_path(e),  'data')
-            local_config['LATITUDE_NORTH'] = e.lat
-            local_config['LONGITUDE_EAST'] = e.lon
-            if e.moment_tensor is not None:
-                local_config['SCAL_MOM_1'], local_config['SCAL_MOM_2'] =\
-                    [e.moment_tensor.moment]*2
-            elif e.magnitude is not None:
-                local_config['SCAL_MOM_1'], local_config['SCAL_MOM_2'] =\
-                    [moment_tensor.magnitude_to_moment(e.magnitude)]*2
-            if try_set_sdr and e.moment_tensor is not None:
-                sdr = e.moment_tensor.both_strike_dip_rake()[0]
-                local_config['STRIKE_1'], local_config['STRIKE_2'] = [float(sdr[0])]*2
-                local_config['DIP_1'], local_config['DIP_2'] = [float(sdr[1])]*2
-                local_config['RAKE_1'], local_config['RAKE_2'] = [float(sdr[2])]*2
-                for key in ['STRIKE_STEP', 'DIP_STEP', 'RAKE_STEP']:
-                    local_config[key] = 1.
-            local_config['SCAL_MOM_STEP'] = 0.
-
-            local_config['DEPTH_1'], local_config['DEPTH_2'], local_config['DEPTH_STEP'] = self.config.get_depths(e)
-            # Is the ORIG_TIME in seconds after 01011970? Doesnt seem to be
-            # working
-            #local_config['ORIG_TIME'] = e.time
-            # postponed....
-            #dc_settings = self.config.get_dc_settings(e)
-            #for component in ['STRIKE', 'DIP', 'RAKE']:
-            #    for sub_component in ['1', '2', 'STEP']:
-            #        local_config['_'.join(component, sub_component)] = dc_settings.next()
-
-            local_config['DEPTH_1'], local_config['DEPTH_2'], local_config['DEPTH_STEP'] = self.config.get_depths(e)
-
-            local_config['DEPTH_UPPERLIM'], local_config['DEPTH_BOTTOMLIM'], local_config['EPIC_DIST_MIN'], local_config['EPIC_DIST_MAX'] = self.gfdb.get_limits(in_km=True)
-            local_config['EPIC_DIST_MAXLOC'] = local_config['EPIC_DIST_MAX']
-            local_config['EPIC_DIST_MAXKIN'] = local_config['EPIC_DIST_MAX']
-            local_config.set_filter(e)
-            inversion = Inversion(parent=self, 
-                                  config=local_config,
-                                  inversion_id=i, 
-                                  force=force,
-                                  picks=self.reader.get_phases_of_event(e))
-
-            ready = inversion.prepare(self.reader, e)
-            if ready:
-                i += 1
-                self.inversions.append(inversion)
-                if i>=num_inversions:
+        if incremental:
+            self.start_manifest()
+        else:
+            make_sane_directories(self.config.base_path, force)
+        for inversion in self.iter_prepare(force=force,
+                                           num_inversions=num_inversions,
+                                           try_set_sdr=try_set_sdr,
+                                           ncpus=ncpus,
+                                           batch=batch,
+                                           memory_budget=memory_budget,
+                                           depth_splits=depth_splits):
+            self.inversions.append(inversion)
+
+    def start_manifest(self):
+        """Reuse *base_path* and load the manifest of previous runs.
+
+        The manifest records a hash of each event's rapidinv input and trace
+        set together with its state. Unchanged events are not written again
+        and inversions already done are skipped by :py:meth:`run_all`."""
+        make_sane_directories(self.config.base_path, force=False, keep=True)
+        self.manifest = Manifest(pjoin(self.config.base_path, 'manifest.json'))
+
+    def iter_prepare(self, force=False, num_inversions=99999999,
+                     try_set_sdr=False, ncpus=1, batch=False,
+                     memory_budget=500e6, depth_splits=1):
+        """Generator yielding prepared :py:class:`Inversion` instances in
+        catalog order. See :py:meth:`prepare` for the parameters."""
+        global _prepare_context
+        if self.config.filter is not None:
+            self.config.filter.precompute(list(self.reader.iter_events()))
+        kwargs = dict(force=force, try_set_sdr=try_set_sdr,
+                      depth_splits=depth_splits)
+        events = ((i, e) for i, e in enumerate(self.reader.iter_events())
+                  if self.out_path(e) not in self.blacklist)
+        if batch:
+            events = sorted(events, key=lambda ie: ie[1].time)
+            indices = [i for i, e in events]
+            tasks = ((i, e, traces, kwargs) for i, (e, traces) in
+                     zip(indices, self.reader.get_waveforms_batch(
+                         [e for i, e in events],
+                         timespan=self.timespan,
+                         reset_time=self.config.reset_time,
+                         left_shift=self.left_shift,
+                         memory_budget=memory_budget)))
+        else:
+            tasks = ((i, e, None, kwargs) for i, e in events)
+
+        pool = None
+        if ncpus != 1:
+            _prepare_context = self
+            logger.info('preparing in %s processes' % ncpus)
+            pool = Pool(ncpus)
+            results = _imap_bounded(pool, _prepare_worker, tasks, 2*ncpus)
+        else:
+            results = (_prepare_task(self, task) for task in tasks)
+
+        if self.get_writer() is not None:
+            results = self.iter_written(results)
+
+        nprepared = 0
+        try:
+            for i, inversion in results:
+                if inversion is None:
+                    continue
+                inversion.parent = self
+                inversion.config.base = self.config
+                if self.manifest is not None and not inversion.up_to_date:
+                    self.manifest.set(inversion.key,
+                                      inversion.input_hash, 'prepared')
+                for part in inversion.split_depths(depth_splits):
+                    if part is not inversion and self.manifest is not None \
+                            and not part.up_to_date:
+                        self.manifest.set(part.key, part.input_hash, 'prepared')
+                    yield part
+                if self.manifest is not None:
+                    self.manifest.save()
+                nprepared += 1
+                if nprepared>=num_inversions:
                     logger.info('reached max number of wanted inversion %s'%num_inversions)
                     break
-            else:
-                logger.info('not preparing %s'%inversion)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def get_writer(self):
+        """:py:class:`WriteBehind` of this process, None if files are
+        written synchronously"""
+        if not self.writer_threads:
+            return None
+        if self._writer is None or self._writer_pid != os.getpid():
+            # threads are not inherited by forked processes
+            self._writer = WriteBehind(self.writer_threads,
+                                       max_pending=2*self.writer_threads,
+                                       fsync=self.fsync)
+            self._writer_pid = os.getpid()
+        return self._writer
+
+    def wait_written(self, inversion):
+        """Wait until the files of *inversion* are written.
+
+        :returns: False if writing failed"""
+        try:
+            self.get_writer().flush(inversion.key)
+            return True
+        except WriteError as e:
+            logger.error('not preparing %s: %s' % (inversion, e))
+            return False
+
+    def iter_written(self, results):
+        """Pass on the (i, inversion) tuples of *results* once the files of
+        the inversion are written, in unchanged order. Up to twice
+        *writer_threads* inversions are held back while being written."""
+        writer = self.get_writer()
+        pending = deque()
+        for i, inversion in results:
+            if inversion is None:
                 continue
+            pending.append((i, inversion))
+            while pending and (len(pending) > 2*self.writer_threads or
+                               writer.is_done(pending[0][1].key)):
+                i, inversion = pending.popleft()
+                if self.wait_written(inversion):
+                    yield i, inversion
 
-    def run_all(self, ncpus=1, log_level=logging.DEBUG, do_log=False, do_align=False):
-        # Auswirkung von maxtaskperchild testen
-        file_paths = []
-        log_file_paths = []
-        pouts = []
-        for inv in self.inversions:
-            file_paths.append(inv.get_execute_filename())
-            log_file_paths.append(inv.get_log_filename())
-        log_levels = [log_level]*len(self.inversions)
-        do_align = [do_align]*len(self.inversions)
-        do_log = [do_log]*len(self.inversions)
-        
-        args = zip(file_paths, log_file_paths, log_levels, do_align, do_log)
-        processes = []
+        while pending:
+            i, inversion = pending.popleft()
+            if self.wait_written(inversion):
+                yield i, inversion
+
+    def make_local_config(self, e, try_set_sdr=False):
+        """Return an overlay of the config with the event specific settings."""
+        local_config = self.config.overlay()
+        local_config['INVERSION_DIR'] = pjoin(self.out_path(e), 'out')
+        local_config['DATA_DIR'] = pjoin(self.out_path(e),  'data')
+        local_config['LATITUDE_NORTH'] = e.lat
+        local_config['LONGITUDE_EAST'] = e.lon
+        if e.moment_tensor is not None:
+            local_config['SCAL_MOM_1'], local_config['SCAL_MOM_2'] =\
+                [e.moment_tensor.moment]*2
+        elif e.magnitude is not None:
+            local_config['SCAL_MOM_1'], local_config['SCAL_MOM_2'] =\
+                [moment_tensor.magnitude_to_moment(e.magnitude)]*2
+        if try_set_sdr and e.moment_tensor is not None:
+            sdr = e.moment_tensor.both_strike_dip_rake()[0]
+            local_config['STRIKE_1'], local_config['STRIKE_2'] = [float(sdr[0])]*2
+            local_config['DIP_1'], local_config['DIP_2'] = [float(sdr[1])]*2
+            local_config['RAKE_1'], local_config['RAKE_2'] = [float(sdr[2])]*2
+            for key in ['STRIKE_STEP', 'DIP_STEP', 'RAKE_STEP']:
+                local_config[key] = 1.
+        local_config['SCAL_MOM_STEP'] = 0.
+
+        # Is the ORIG_TIME in seconds after 01011970? Doesnt seem to be
+        # working
+        #local_config['ORIG_TIME'] = e.time
+        # postponed....
+        #dc_settings = self.config.get_dc_settings(e)
+        #for component in ['STRIKE', 'DIP', 'RAKE']:
+        #    for sub_component in ['1', '2', 'STEP']:
+        #        local_config['_'.join(component, sub_component)] = dc_settings.next()
+
+        local_config['DEPTH_1'], local_config['DEPTH_2'], local_config['DEPTH_STEP'] = self.config.get_depths(e)
+
+        local_config['DEPTH_UPPERLIM'], local_config['DEPTH_BOTTOMLIM'], local_config['EPIC_DIST_MIN'], local_config['EPIC_DIST_MAX'] = self.gfdb.get_limits(in_km=True)
+        local_config['EPIC_DIST_MAXLOC'] = local_config['EPIC_DIST_MAX']
+        local_config['EPIC_DIST_MAXKIN'] = local_config['EPIC_DIST_MAX']
+        local_config.set_filter(e)
+        return local_config
+
+    def prepare_event(self, i, e, traces=None, force=False, try_set_sdr=False,
+                      depth_splits=1):
+        """Prepare the inversion of a single event.
+
+        :param traces: waveforms of the event. Retrieved from the reader if
+        None.
+        :param depth_splits: see :py:meth:`prepare`
+        :returns: :py:class:`Inversion` or None if the event cannot be inverted
+        """
+        manifest_entry = None
+        if self.manifest is not None:
+            manifest_entry = self.manifest.get(self.out_path(e))
+            # stale event directories are replaced
+            force = True
+
+        inversion = Inversion(parent=self,
+                              config=self.make_local_config(e, try_set_sdr),
+                              inversion_id=i,
+                              force=force,
+                              picks=self.reader.get_phases_of_event(e),
+                              depth_splits=depth_splits)
+
+        if inversion.prepare(self.reader, e, traces=traces,
+                             manifest_entry=manifest_entry):
+            return inversion
+        else:
+            logger.info('not preparing %s'%inversion)
+            return None
+
+    def run_all(self, ncpus=1, log_level=logging.DEBUG, do_log=False,
+                do_align=False, maxtasksperchild=None, order='cost',
+                policy=None):
+        """Run all prepared inversions.
+
+        :param ncpus: number of worker processes
+        :param maxtasksperchild: replace a worker after that many
+        inversions to release its memory (default: keep workers alive)
+        :param order: 'cost' (default) starts the inversions with the
+        longest predicted run time first, see :py:class:`CostModel`. None
+        keeps the order of *self.inversions*.
+        :param policy: :py:class:`TaskPolicy` with timeout, memory limit
+        and retries of the rapidinv runs (default: no limits)
+        :returns: list of :py:class:`TaskResult`, ordered as
+        *self.inversions*. In incremental mode inversions which are already
+        done are skipped and have no result.
+        """
+        inversions = self.get_pending_inversions(order)
+        by_filename = dict((inv.get_execute_filename(), inv)
+                           for inv in inversions)
+        args = [inv.get_run_args(log_level, do_log, do_align)
+                for inv in inversions]
+        func = policy or run_task
         if ncpus!=1:
-            logger.info("starting parallel %s+1 processes"%(ncpus))
-            tasks = Queue()
-
-            for i in range(ncpus+1):
-                p = Process(target=worker, args=(tasks, len(args)))
-                p.start()
-                processes.append(p)
-            
-            for iarg, arg in enumerate(args):
-                tasks.put(arg)
-            
-            tasks.put('stop')
-            tasks.close()
-
-            for p in processes:
-                p.join()
-                p.terminate()
+            logger.info("starting pool of %s processes"%(ncpus))
+            pool = Pool(ncpus, maxtasksperchild=maxtasksperchild)
+            try:
+                results = []
+                for result in pool.imap_unordered(func, args):
+                    self.handle_result(by_filename[result.args[0]], result)
+                    results.append(result)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = []
+            for arg in args:
+                result = func(arg)
+                self.handle_result(by_filename[arg[0]], result)
+                results.append(result)
+
+        return self.finish(results, ncpus)
+
+    def get_pending_inversions(self, order='cost'):
+        """Inversions which are not done, see :py:meth:`run_all` for
+        *order*."""
+        inversions = [inv for inv in self.inversions if not self.is_done(inv)]
+        if len(inversions) < len(self.inversions):
+            logger.info('skipping %s inversions which are done' % (
+                len(self.inversions) - len(inversions)))
+        if order == 'cost':
+            predictions = self.get_cost_model().predict(inversions)
+            # stable, equal estimates keep the catalog order
+            inversions = [inv for (prediction, inv) in sorted(
+                zip(predictions, inversions), key=lambda pi: -pi[0])]
+        return inversions
+
+    def finish(self, results, ncpus=1):
+        """Sort *results* as *self.inversions* and write the summaries of a
+        run.
+
+        :param ncpus: number of processes harvesting the results"""
+        index = dict((inv.get_execute_filename(), i)
+                     for i, inv in enumerate(self.inversions))
+        results.sort(key=lambda result: index[result.args[0]])
+        self.get_cost_model().save()
+        if self.manifest is not None:
+            self.manifest.compact()
+        self.merge_depths()
+        self.harvest(ncpus)
+        self.write_report()
+        return results
+
+    def run_distributed(self, queue_dir=None, nworkers=0,
+                        log_level=logging.DEBUG, do_log=False, do_align=False,
+                        order='cost', policy=None, poll=1., stale_after=300.):
+        """Run all prepared inversions through a task queue on a shared
+        file system, see :py:mod:`taskqueue`.
+
+        The inversions are run by worker daemons (worker.py) on hosts which
+        see the queue and the inversion directories under the same paths,
+        and by *nworkers* local worker processes.
+
+        :param queue_dir: queue directory (default: *queue* in the base
+            path). Tasks left from earlier runs are removed.
+        :param nworkers: number of local worker processes
+        :param policy: :py:class:`TaskPolicy` of the local workers. Its
+            retries and retry overrides are published with the tasks and
+            followed by the worker daemons as well.
+        :param poll: seconds between checks for finished tasks
+        :param stale_after: seconds without heartbeat after which the task
+            of a dead worker is handed out again
+        See :py:meth:`run_all` for the other parameters.
+        """
+        queue = TaskQueue(queue_dir or pjoin(self.config.base_path, 'queue'),
+                          stale_after=stale_after)
+        queue.reset()
+        by_id = {}
+        for rank, inversion in enumerate(self.get_pending_inversions(order)):
+            task_id = '%06i_%s' % (rank, inversion.key)
+            payload = {'args': list(inversion.get_run_args(
+                log_level, do_log, do_align))}
+            if policy is not None:
+                # remote workers retry like the local ones
+                payload['retries'] = policy.retries
+                payload['retry_overrides'] = policy.retry_overrides
+            queue.put(task_id, payload)
+            by_id[task_id] = inversion
+        logger.info('published %i tasks to %s' % (len(by_id), queue.directory))
+
+        workers = [Process(target=queue_worker,
+                           args=(queue.directory, policy, stale_after),
+                           kwargs={'poll': poll, 'exit_when_drained': True,
+                                   'heartbeat': min(30., stale_after/4.)})
+                   for i in range(nworkers)]
+        for worker in workers:
+            worker.start()
+
+        results = []
+        try:
+            while by_id:
+                for task_id in queue.list('done'):
+                    if task_id not in by_id:
+                        continue
+                    result = TaskResult.from_dict(queue.get_result(task_id))
+                    self.handle_result(by_id.pop(task_id), result)
+                    results.append(result)
+                if by_id:
+                    queue.reclaim_stale()
+                    time.sleep(poll)
+        finally:
+            for worker in workers:
+                if by_id:
+                    worker.terminate()
+                worker.join()
+
+        return self.finish(results, max(nworkers, 1))
 
+    def is_done(self, inversion):
+        """True if the manifest lists the inversion with unchanged inputs as
+        done and its output directory is not empty."""
+        if self.manifest is None:
+            return False
+        out_dir = inversion.config['INVERSION_DIR']
+        return self.manifest.is_done(inversion.key,
+                                     inversion.input_hash) and \
+            os.path.isdir(out_dir) and len(os.listdir(out_dir)) > 0
+
+    def get_cost_model(self):
+        if self.cost_model is None:
+            # next to base_path, which is removed by prepare(force=True)
+            self.cost_model = CostModel(
+                self.config.base_path.rstrip(os.sep) + '.costs.json')
+        return self.cost_model
+
+    def handle_result(self, inversion, result):
+        """Called in the parent process for every finished inversion."""
+        inversion.result = result
+        if result.status in ('ok', 'timeout', 'oom'):
+            # killed runs took at least that long
+            self.get_cost_model().add(inversion.key, inversion.estimate_cost(),
+                                      result.duration,
+                                      lower_bound=not result.ok)
+        self.recorder.add('run', inversion.key, wall=result.duration,
+                          cpu=result.cpu, status=result.status,
+                          ntraces=inversion.ntraces)
+        if result.ok and self.read_result(
+                inversion.config['INVERSION_DIR']) is None:
+            if self.manifest is not None:
+                self.manifest.set_state(inversion.key, 'failed',
+                                        status='no_result',
+                                        attempts=result.attempts)
+                self.manifest.save()
+            raise RapidinvResultError(
+                'rapidinv finished %s without writing %s into %s. Set '
+                'result_filename and result_keys to the summary rapidinv '
+                'writes.' % (inversion.key, self.result_filename,
+                             inversion.config['INVERSION_DIR']))
+        if result.ok and not inversion.suffix:
+            self.harvest_inversion(inversion)
+        if self.manifest is not None:
+            self.manifest.set_state(inversion.key,
+                                    'done' if result.ok else 'failed',
+                                    status=result.status,
+                                    attempts=result.attempts)
+            self.manifest.save()
+        if result.status in ('minimizer_error', 'timeout', 'oom'):
+            logger.info('WARNING: %s in %s: %s' % (
+                result.status, inversion, result.exception))
+        elif result.status != 'ok':
+            logger.error('inversion %s failed:\n%s' % (inversion,
+                                                       result.traceback))
         else:
-            map(run_rapidinv, args)
-        
+            logger.info('finished %s' % result)
+
+    def run_streaming(self, ncpus=1, prepare_ncpus=1, force=False,
+                      log_level=logging.DEBUG, do_log=False, do_align=False,
+                      maxtasksperchild=None, incremental=False, policy=None,
+                      **prepare_kwargs):
+        """Prepare and run inversions concurrently.
+
+        Each inversion is handed to the pool of *ncpus* rapidinv workers as
+        soon as its input directory is written, so that the minimization of
+        early events overlaps with the data preparation of later ones. See
+        :py:meth:`prepare` and :py:meth:`run_all` for the other parameters.
+
+        :param prepare_ncpus: number of processes preparing events
+        :param incremental: see :py:meth:`prepare`
+        :param policy: see :py:meth:`run_all`
+        :param prepare_kwargs: passed to :py:meth:`iter_prepare`
+        :returns: list of :py:class:`TaskResult` in the order of
+        *self.inversions*
+        """
+        logger.debug('streaming, force=%s'%force)
+        if incremental:
+            self.start_manifest()
+        else:
+            make_sane_directories(self.config.base_path, force)
+        pool = Pool(ncpus, maxtasksperchild=maxtasksperchild)
+        pending = []
+        results = []
+        try:
+            for inversion in self.iter_prepare(force=force,
+                                               ncpus=prepare_ncpus,
+                                               **prepare_kwargs):
+                self.inversions.append(inversion)
+                # record finished inversions right away, so that their state
+                # survives a failure while preparing later events
+                pending = self.collect_ready(pending, results)
+                if self.is_done(inversion):
+                    continue
+                logger.info('queue %s' % inversion)
+                pending.append((inversion, pool.apply_async(
+                    policy or run_task,
+                    (inversion.get_run_args(log_level, do_log, do_align),))))
+            pool.close()
+            self.collect_ready(pending, results, wait=True)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return self.finish(results, ncpus)
+
+    def collect_ready(self, pending, results, wait=False):
+        """Handle the finished tasks of *pending*, a list of (inversion,
+        AsyncResult) tuples, and append their results to *results*.
+
+        :param wait: wait for all tasks
+        :returns: list of the tasks still running"""
+        running = []
+        for inversion, async_result in pending:
+            if wait or async_result.ready():
+                result = async_result.get()
+                self.handle_result(inversion, result)
+                results.append(result)
+            else:
+                running.append((inversion, async_result))
+        return running
+
+    def merge_depths(self):
+        """Collect the results of inversions split by depth.
+
+        For every event, the result files of the sub-range with the lowest
+        misfit are copied to the event's *out* directory, and
+        depth_parts.txt lists misfit and depth range of all sub-ranges.
+
+        :returns: dict of event key to best result, see :py:func:`read_result`
+        """
+        groups = OrderedDict()
+        for inversion in self.inversions:
+            if inversion.suffix:
+                groups.setdefault(inversion.event_key, []).append(inversion)
+
+        best = OrderedDict()
+        for event_key, parts in groups.items():
+            lines = []
+            candidates = []
+            for part in parts:
+                result = self.read_result(part.config['INVERSION_DIR'])
+                z1, z2, dz = part.get_depths()
+                misfit = result.get('misfit') if result else None
+                lines.append('%s %s %s %s\n' % (part.suffix, z1, z2, misfit))
+                if misfit is not None:
+                    candidates.append((float(misfit), part, result))
+
+            out_dir = pjoin(self.config.base_path, event_key, 'out')
+            with open(pjoin(out_dir, 'depth_parts.txt'), 'w') as f:
+                f.writelines(lines)
+
+            if not candidates:
+                logger.warning('no depth results for %s' % event_key)
+                continue
+
+            misfit, part, result = min(candidates, key=lambda c: c[0])
+            part_dir = part.config['INVERSION_DIR']
+            for fn in os.listdir(part_dir):
+                if os.path.isfile(pjoin(part_dir, fn)):
+                    shutil.copy(pjoin(part_dir, fn), pjoin(out_dir, fn))
+            best[event_key] = result
+            logger.info('%s: best depth range %s' % (event_key, part.suffix))
+
+        return best
+
+    def get_harvester(self):
+        if self.harvester is None:
+            self.harvester = Harvester(
+                pjoin(self.config.base_path, 'results.csv'),
+                pjoin(self.config.base_path, 'results.pf'))
+        return self.harvester
+
+    def read_result(self, directory):
+        """:py:func:`read_result` with the summary file and names of this
+        instance"""
+        return read_result(directory, self.result_filename, self.result_keys)
+
+    def get_result_dir(self, inversion):
+        """Directory of the final result of the event of *inversion*"""
+        return pjoin(self.config.base_path, inversion.event_key, 'out')
+
+    def harvest_inversion(self, inversion):
+        """Add the result of a finished inversion to the results table."""
+        harvester = self.get_harvester()
+        if harvester.is_current(inversion.event_key, inversion.input_hash):
+            return
+        result_dir = self.get_result_dir(inversion)
+        result = self.read_result(result_dir)
+        if result is None:
+            logger.warning('no %s in %s' % (self.result_filename, result_dir))
+        else:
+            harvester.add(inversion.event_key, inversion.event, result,
+                          inversion.input_hash)
+
+    def get_result_hashes(self):
+        """Hash of the inputs of the final result of every event: the input
+        hash of its inversion or, for events split by depth, a hash of the
+        input hashes of all parts.
+
+        :returns: dict of event key to (hash, first inversion of the event)
+        """
+        groups = OrderedDict()
+        for inversion in self.inversions:
+            groups.setdefault(inversion.event_key, []).append(inversion)
+        hashes = OrderedDict()
+        for event_key, inversions in groups.items():
+            if len(inversions) == 1:
+                input_hash = inversions[0].input_hash
+            else:
+                input_hash = hashlib.md5('\n'.join(
+                    inv.input_hash for inv in inversions).encode('utf-8')
+                ).hexdigest()
+            hashes[event_key] = (input_hash, inversions[0])
+        return hashes
+
+    def harvest(self, ncpus=1):
+        """Add the results of all events which are not in the results
+        table yet or were harvested from other inputs, see
+        :py:class:`harvest.Harvester`. Result files are read by *ncpus*
+        processes.
+
+        The table results.csv and the events with moment tensors
+        results.pf are kept in *base_path*. Results of events which are
+        not split by depth are added by :py:meth:`handle_result` as soon as
+        their inversion has finished.
+
+        Events without result file, e.g. of failed inversions, are
+        counted and listed at debug level.
+
+        :returns: number of added events
+        """
+        harvester = self.get_harvester()
+        todo = OrderedDict()
+        for event_key, (input_hash, inversion) in \
+                self.get_result_hashes().items():
+            if not harvester.is_current(event_key, input_hash):
+                todo[event_key] = (input_hash, inversion)
+
+        directories = [self.get_result_dir(inv) for h, inv in todo.values()]
+        if ncpus != 1 and len(directories) > 1:
+            pool = Pool(ncpus)
+            try:
+                results = pool.map(_read_result_task, [
+                    (directory, self.result_filename, self.result_keys)
+                    for directory in directories])
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [self.read_result(directory)
+                       for directory in directories]
+
+        nadded = 0
+        missing = []
+        for (event_key, (input_hash, inversion)), result in zip(
+                todo.items(), results):
+            if result is None:
+                missing.append(event_key)
+            else:
+                harvester.add(event_key, inversion.event, result, input_hash)
+                nadded += 1
+        harvester.save_events()
+        logger.info('harvested %i new results, %i in total' % (
+            nadded, len(harvester.rows)))
+        if missing:
+            logger.warning('no %s for %i events' % (self.result_filename,
+                                                     len(missing)))
+            logger.debug('events without result: %s' % ', '.join(missing))
+        return nadded
+
+    def write_report(self):
+        """Write the timing records of the reader, the preparation of all
+        inversions and the rapidinv runs to report.csv and, together with
+        per stage statistics, to report.json in *base_path*.
+
+        :returns: :py:class:`instrumentation.Recorder` holding all records
+        """
+        recorder = Recorder()
+        recorder.extend(self.reader.recorder.records)
+        for inversion in self.inversions:
+            recorder.extend(inversion.recorder.records)
+        recorder.extend(self.recorder.records)
+        recorder.dump_json(pjoin(self.config.base_path, 'report.json'))
+        recorder.dump_csv(pjoin(self.config.base_path, 'report.csv'))
+        recorder.log_summary()
+        return recorder
+
     def out_path(self, event):
         file_path = '_'.join(event.time_as_string().split())
         file_path = file_path.replace(':', '')
@@ -337,53 +1618,237 @@ class MultiEventInversion():
         return file_path
 
 
-class Inversion(Process):
+class Inversion():
     def __init__(self, parent, config, inversion_id=None, force=False,
-                 picks=None):
-        Process.__init__(self)
+                 picks=None, depth_splits=1):
         self.parent = parent
         self.config = config
         self.force = force
         self.inversion_id = inversion_id
         self.picks = picks
+        self.depth_splits = depth_splits
     
         self.event = None
+        self.result = None
+        self.input_hash = None
+        self.up_to_date = False
+        self.base_path = self.config['INVERSION_DIR'].rsplit('/', 1)[0]
+        self.event_key = os.path.basename(self.base_path)
+        # distinguishes inversions of parts of the depth range of one event
+        self.suffix = ''
+        self.key = self.event_key
+        self.recorder = Recorder()
+        self.ntraces = 0
+        self.nsamples = 0
     
-    def prepare(self, reader, event):
+    def prepare(self, reader, event, traces=None, manifest_entry=None):
+        """Write the input of this inversion.
+
+        :param traces: use these waveforms instead of retrieving them
+        :param manifest_entry: manifest entry of a previous run. If the
+        input hash did not change, existing files are reused."""
         self.event = event
-        status = self.make_data(reader)
+        status = self.make_data(reader, traces)
         if status==True:
+            # part of the input file, also if the station file is reused
+            self.config['STAT_INP_FILE'] = self.get_station_filename()
+            self.input_hash = self.get_input_hash()
+            if manifest_entry is not None and \
+                    manifest_entry['hash']==self.input_hash and \
+                    os.path.exists(self.get_written_filename()):
+                logger.info('unchanged, reusing %s' % self.base_path)
+                self.up_to_date = True
+                return True
+
             self.make_directories()
             try:
-                self.make_station_file()
+                with self.recorder.stage('prepare.station_file', self.key):
+                    self.make_station_file()
             except RapidinvDataError:
                 return False
-            self.write_data()
-            self.write_pyrocko_event()
-            self.make_rapidinv_file()
-            self.write_picks()
+            with self.recorder.stage('prepare.write', self.key) as record:
+                record['ntraces'] = len(self.traces)
+                writer = self.parent.get_writer()
+                if writer is None:
+                    self.write_files(record=record)
+                else:
+                    # blocks while the writer is busy
+                    writer.submit(self.key, self.write_files,
+                                  self.config.make_rapidinv_input(), record)
             return True
         else:
             return False
 
     def make_directories(self):
-        self.base_path = self.config['INVERSION_DIR'].rsplit('/', 1)[0] 
         logger.info('creating output directory: %s'%self.base_path)
         make_sane_directories(self.base_path, self.force)
         make_sane_directories(self.config['INVERSION_DIR'], self.force)
         make_sane_directories(self.config['DATA_DIR'], self.force)
     
+    def get_input_hash(self):
+        """Hash of the rapidinv configuration and the conditioned traces,
+        including their samples, so that changes of gains, polarities or
+        taper are noticed."""
+        h = hashlib.md5()
+        h.update(self.config.make_rapidinv_input().encode('utf-8'))
+        for tr in sorted(self.traces, key=lambda tr: tr.nslc_id):
+            ydata = num.ascontiguousarray(tr.get_ydata())
+            h.update(('%s %r %r %i %s\n' % ('.'.join(tr.nslc_id), tr.tmin,
+                                            tr.deltat, tr.data_len(),
+                                            ydata.dtype.str)
+                      ).encode('utf-8'))
+            h.update(ydata.tobytes())
+        return h.hexdigest()
+
     def get_execute_filename(self):
-        return pjoin(self.base_path, 'rapid.inp')
+        return pjoin(self.base_path, 'rapid%s.inp' % self.suffix)
+
+    def get_written_filename(self):
+        """File written last by :py:meth:`write_files`"""
+        if len(self.get_depth_parts(self.depth_splits)) < 2:
+            return self.get_execute_filename()
+        return pjoin(self.config['DATA_DIR'], 'phase_picks.pf')
 
     def get_log_filename(self):
-        return pjoin(self.base_path, 'rapid.log')
+        return pjoin(self.base_path, 'rapid%s.log' % self.suffix)
+
+    def get_grid_size(self, name):
+        """Number of grid points of parameter *name* (e.g. 'STRIKE')"""
+        try:
+            v1, v2, step = [float(self.config['%s_%s' % (name, k)])
+                            for k in ['1', '2', 'STEP']]
+        except KeyError:
+            return 1
+        if step <= 0.:
+            return 1
+        return int(round((v2-v1)/step)) + 1
+
+    def estimate_cost(self):
+        """Relative cost: number of samples times size of the grid search"""
+        cost = float(self.nsamples)
+        for name in ['STRIKE', 'DIP', 'RAKE', 'DEPTH']:
+            cost *= self.get_grid_size(name)
+        return cost
+
+    def get_depths(self):
+        """Depth grid (z1, z2, dz) in km"""
+        return tuple(float(self.config[k])
+                     for k in ['DEPTH_1', 'DEPTH_2', 'DEPTH_STEP'])
+
+    def get_depth_parts(self, nparts):
+        """Indices into the depth grid of up to *nparts* contiguous
+        sub-ranges, a single range if the grid cannot be split"""
+        z1, z2, dz = self.get_depths()
+        if nparts < 2 or dz <= 0.:
+            return [None]
+        ndepths = int(round((z2-z1)/dz)) + 1
+        return num.array_split(num.arange(ndepths), min(nparts, ndepths))
+
+    def split_depths(self, nparts):
+        """Split the depth grid into up to *nparts* contiguous sub-ranges.
+
+        The returned inversions share the data directory of this inversion
+        and have their own output directory out_z<i>, input file
+        rapid_z<i>.inp and log file. Their input files are written unless
+        the manifest lists them with an unchanged input hash, which covers
+        the data of the event and the rendered input file of the part.
+        Files and manifest entries of parts of an earlier split which are
+        not among them are removed.
 
-    def make_data(self, reader):
-        self.traces = reader.get_waveforms(self.event, timespan=20.,
-                                           reset_time=self.config.reset_time, 
-                                           left_shift=self.parent.left_shift)
-        self.parent.gfdb.adjust_sampling_rates(self.traces)
+        :returns: list of :py:class:`Inversion`, [self] if the depth grid
+        cannot be split
+        """
+        depth_parts = self.get_depth_parts(nparts)
+        if len(depth_parts) < 2:
+            self.remove_stale_parts([self.suffix])
+            return [self]
+
+        z1, z2, dz = self.get_depths()
+        parts = []
+        for ipart, idepths in enumerate(depth_parts):
+            part = copy.copy(self)
+            part.parent = self.parent
+            part.suffix = '_z%i' % ipart
+            part.key = self.event_key + part.suffix
+            part.recorder = Recorder()
+            part.result = None
+            part.config = self.config.copy()
+            part.config['INVERSION_DIR'] = pjoin(self.event_key,
+                                                 'out%s' % part.suffix)
+            part.config['DEPTH_1'] = z1 + idepths[0]*dz
+            part.config['DEPTH_2'] = z1 + idepths[-1]*dz
+            rapidinv_input = part.config.make_rapidinv_input()
+            part.input_hash = hashlib.md5(
+                ('%s\n%s' % (self.input_hash, rapidinv_input)
+                 ).encode('utf-8')).hexdigest()
+
+            entry = None
+            if self.parent.manifest is not None:
+                entry = self.parent.manifest.get(part.key)
+            part.up_to_date = self.up_to_date and entry is not None and \
+                entry['hash'] == part.input_hash and \
+                os.path.exists(part.get_execute_filename())
+            if not part.up_to_date:
+                # results of a different sub-range must not be reused
+                make_sane_directories(part.config['INVERSION_DIR'],
+                                      force=True)
+                part.make_rapidinv_file(rapidinv_input)
+            parts.append(part)
+
+        self.remove_stale_parts([part.suffix for part in parts])
+        return parts
+
+    def remove_stale_parts(self, suffixes):
+        """Remove the input files, logs and output directories of depth
+        parts and of the unsplit inversion which are not in *suffixes*, see
+        :py:meth:`split_depths`."""
+        found = set()
+        for fn in glob.glob(pjoin(self.base_path, 'rapid*.inp')):
+            found.add(os.path.basename(fn)[len('rapid'):-len('.inp')])
+        for fn in glob.glob(pjoin(self.base_path, 'out_z*')):
+            found.add(os.path.basename(fn)[len('out'):])
+        manifest = self.parent.manifest
+        if manifest is not None:
+            # entries of parts whose directories went with the event's
+            ipart = 0
+            while manifest.get('%s_z%i' % (self.event_key, ipart)):
+                found.add('_z%i' % ipart)
+                ipart += 1
+
+        for suffix in sorted(found - set(suffixes)):
+            if suffix and not re.match(r'_z\d+$', suffix):
+                continue
+            logger.debug('removing stale depth part %s%s' % (self.event_key,
+                                                             suffix))
+            for fn in ['rapid%s.inp' % suffix, 'rapid%s.log' % suffix]:
+                if os.path.exists(pjoin(self.base_path, fn)):
+                    os.remove(pjoin(self.base_path, fn))
+            if suffix:
+                # the output of the unsplit inversion takes the merged result
+                shutil.rmtree(pjoin(self.base_path, 'out%s' % suffix),
+                              ignore_errors=True)
+                if manifest is not None:
+                    manifest.remove(self.event_key + suffix)
+
+    def get_run_args(self, log_level=logging.DEBUG, do_log=False,
+                     do_align=False):
+        """Arguments tuple as expected by :py:func:`run_rapidinv`."""
+        return (self.get_execute_filename(), self.get_log_filename(),
+                log_level, do_align, do_log)
+
+    def make_data(self, reader, traces=None):
+        if traces is None:
+            with self.recorder.stage('prepare.get_waveforms', self.key) as record:
+                traces = reader.get_waveforms(self.event,
+                                              timespan=self.parent.timespan,
+                                              reset_time=self.config.reset_time, 
+                                              left_shift=self.parent.left_shift)
+                record['ntraces'] = len(traces)
+        self.traces = traces
+        self.ntraces = len(traces)
+        with self.recorder.stage('prepare.resample', self.key):
+            self.parent.gfdb.adjust_sampling_rates(self.traces)
+        self.nsamples = sum(tr.data_len() for tr in self.traces)
         if self.traces==None:
             logger.debug('No Data found %s'%self.event)
             return False
@@ -399,13 +1864,15 @@ class Inversion(Process):
             logger.info('Found Data %s'%self.event.time_as_string())
             return True
 
+    def get_station_filename(self):
+        return pjoin(self.base_path, 'data', 'stations.txt')
+
     def make_station_file(self):
         num_stations, self.out_of_bounds, stats = self.config.make_rapidinv_stations_string(self.traces,
                                                         self.event, 
                                                         self.parent.gfdb)
         
-        fn = pjoin(self.base_path, 'data', 'stations.txt')
-        self.config['STAT_INP_FILE'] = fn
+        fn = self.get_station_filename()
         with open(fn, 'w') as f:
             f.write(stats)
 
@@ -413,28 +1880,63 @@ class Inversion(Process):
         if num_stations<2:
             raise RapidinvDataError
 
+    def write_files(self, rapidinv_input=None, record=None):
+        """Write traces, event, rapidinv input file and picks. The input
+        file is left out if the depth grid is split, see
+        :py:meth:`split_depths`.
+
+        :param record: timing record of the write stage, which is given the
+            number of written *bytes*
+        :returns: list of the written directories"""
+        self.write_data()
+        self.write_pyrocko_event()
+        if len(self.get_depth_parts(self.depth_splits)) < 2:
+            self.make_rapidinv_file(rapidinv_input)
+        self.write_picks()
+        if record is not None:
+            record['bytes'] = directory_size(self.base_path)
+        return [self.base_path]
+
     def write_data(self):
+        filenames = []
         for tr in self.traces:
             fn = 'DISPL.%s.%s'%(tr.station, tr.channel)
-            if tr.nslc_id[::3] in self.out_of_bounds:
+            if tr.nslc_id[:3] in self.out_of_bounds:
                 fn = 'OOB.' + fn
-            fn = pjoin(self.config['DATA_DIR'], fn)
-            io.save(tr, fn)
+            filenames.append(fn)
+
+        if self.parent.bundle:
+            write_bundle(pjoin(self.config['DATA_DIR'], BUNDLE_FILENAME),
+                         self.traces, filenames,
+                         meta={'event': self.key})
+        else:
+            for tr, fn in zip(self.traces, filenames):
+                io.save(tr, pjoin(self.config['DATA_DIR'], fn))
     
     def write_pyrocko_event(self):
         fn = pjoin(self.config['DATA_DIR'], 'event.pf')
+        event = self.event
         if self.config.reset_time:
-            self.event.time = 0.
-        model.dump_events([self.event], fn)
+            event = copy.copy(event)
+            event.time = 0.
+        model.dump_events([event], fn)
 
     def write_picks(self):
         fn = pjoin(self.config['DATA_DIR'], 'phase_picks.pf')
         gui_util.save_markers(self.picks, fn)
 
-    def make_rapidinv_file(self):
-        fn = pjoin(self.base_path, 'rapid.inp')
+    def make_rapidinv_file(self, rapidinv_input=None):
+        fn = self.get_execute_filename()
         with open(fn, 'w') as f:
-            f.write(self.config.make_rapidinv_input())
+            f.write(rapidinv_input or self.config.make_rapidinv_input())
+
+    def __getstate__(self):
+        """Parent and traces stay in the process which prepared the
+        inversion."""
+        state = self.__dict__.copy()
+        state['parent'] = None
+        state.pop('traces', None)
+        return state
 
     def __str__(self):
         return "id %s, %s"%(self.inversion_id, self.config.base_path)
@@ -1,4 +1,4 @@
-from pyrocko import io, model, pile, gui_util
+from pyrocko import io, model, pile, gui_util, orthodrome, trace, util
 import subprocess
 import sys
 from os.path import join as pjoin
@@ -7,41 +7,180 @@ import glob
 from collections import defaultdict
 import logging
 import numpy as num
+from instrumentation import Recorder
 
 logger = logging.getLogger('wrapidinv')
 
-def load_station_corrections(fn, combine_channels=True):
-    """
-    :param combine_channels: if True, return one correction per station, which is the
-                             mean of all phases"""
-    corrections = {}
+def own_float_data(tr):
+    """Make sure *tr* holds its own floating point copy of its samples."""
+    ydata = tr.get_ydata()
+    if ydata.dtype.kind != 'f':
+        tr.set_ydata(ydata.astype(num.float64))
+    elif not ydata.flags.owndata or not ydata.flags.writeable:
+        tr.set_ydata(ydata.copy())
+
+_string_types = (str, type(u''))
+
+def as_nslc_ids(ids, name):
+    """*ids* as list of (network, station, location, channel) tuples.
+
+    :param name: parameter name used in the error message
+    :raises: ValueError if an entry is not a sequence of four codes"""
+    nslc_ids = []
+    for nslc_id in ids:
+        if isinstance(nslc_id, _string_types) or len(nslc_id) != 4 or \
+                not all(isinstance(code, _string_types) for code in nslc_id):
+            raise ValueError('%s: expected (network, station, location, '
+                             'channel) tuples, got %r' % (name, nslc_id))
+        nslc_ids.append(tuple(nslc_id))
+    return nslc_ids
+
+def iter_markers(fn):
+    """Generator parsing a Snuffler marker file (version 0.2), yielding
+    :py:class:`pyrocko.gui_util.PhaseMarker` instances. Rows of other
+    marker types are skipped."""
     with open(fn, 'r') as f:
-        for l in f.readlines():
-            nslc_id, phasename, residual = l.split()
-            nslc_id = tuple(nslc_id.split('.'))
-            if not nslc_id in corrections.keys():
-                corrections[nslc_id] = {}
-            if residual=='None':
-                residual = None
-            else:
-                residual = float(residual)
+        line = f.readline()
+        if not line.startswith('# Snuffler Markers File Version 0.2'):
+            raise gui_util.MarkerParseError('Unsupported marker file: %s' % fn)
+        reader = util.TableReader(f)
+        while not reader.eof:
+            row = reader.readrow()
+            if not row or row[0] != 'phase:':
+                continue
+            try:
+                yield gui_util.PhaseMarker.from_attributes(row)
+            except (gui_util.MarkerParseError, IndexError, ValueError):
+                logger.warning('invalid marker: %s' % ' '.join(row))
+
+class StationCorrections():
+    """Table of travel time residuals per channel and phase.
+
+    :py:attr:`table` is a structured array with the fields *ichannel*
+    (index into :py:attr:`nslc_ids`), *phase* and *residual* (NaN where
+    missing)."""
+    def __init__(self, nslc_ids, table):
+        self.nslc_ids = nslc_ids
+        self.table = table
+
+    @classmethod
+    def load(cls, fn):
+        """Read a file of 'NET.STA.LOC.CHA phase residual' lines, with
+        residual 'None' if missing."""
+        with open(fn, 'r') as f:
+            columns = num.array(f.read().split()).reshape(-1, 3)
+        codes, ichannels = num.unique(columns[:, 0], return_inverse=True)
+        residuals = columns[:, 2].copy()
+        residuals[residuals == 'None'] = 'nan'
+        table = num.empty(columns.shape[0], dtype=[
+            ('ichannel', num.int32),
+            ('phase', columns.dtype),
+            ('residual', num.float64)])
+        table['ichannel'] = ichannels
+        table['phase'] = columns[:, 1]
+        table['residual'] = residuals.astype(num.float64)
+        return cls([tuple(str(code).split('.')) for code in codes], table)
 
-            corrections[nslc_id][phasename] = residual
+    def aggregate(self, by='station', method='mean', phases=None):
+        """Combine the residuals of all phases per station or channel.
+
+        :param by: 'station' to group by NSL ids, 'channel' by NSLC ids
+        :param method: 'mean' or 'median'
+        :param phases: only use residuals of these phases
+        :returns: dict of id to residual. Ids without any residual are
+                  left out.
+        """
+        if by == 'station':
+            keys = [nslc_id[:3] for nslc_id in self.nslc_ids]
+        elif by == 'channel':
+            keys = list(self.nslc_ids)
+        else:
+            raise ValueError('cannot aggregate by %s' % by)
+
+        unique_keys = sorted(set(keys))
+        key_index = dict((k, i) for i, k in enumerate(unique_keys))
+        channel_group = num.array([key_index[k] for k in keys], dtype=num.int64)
+
+        residuals = self.table['residual']
+        use = ~num.isnan(residuals)
+        if phases is not None:
+            use &= num.in1d(self.table['phase'], phases)
+        groups = channel_group[self.table['ichannel'][use]]
+        residuals = residuals[use]
+        ngroups = len(unique_keys)
+        counts = num.bincount(groups, minlength=ngroups)
+
+        if method == 'mean':
+            sums = num.bincount(groups, weights=residuals, minlength=ngroups)
+            values = sums / num.maximum(counts, 1)
+        elif method == 'median':
+            order = num.lexsort((residuals, groups))
+            values = num.zeros(ngroups)
+            for igroup, group_residuals in zip(
+                    num.unique(groups),
+                    num.split(residuals[order],
+                              num.cumsum(counts[counts > 0])[:-1])):
+                values[igroup] = num.median(group_residuals)
+        else:
+            raise ValueError('unknown method %s' % method)
+
+        return dict((k, float(v)) for k, v, n in
+                    zip(unique_keys, values, counts) if n > 0)
+
+    def lookup(self, method='mean'):
+        """Correction per NSL id as used by :py:class:`Reader`"""
+        return self.aggregate('station', method)
+
+    def as_dict(self):
+        """Nested dict NSLC id -> phase -> residual (None if missing)"""
+        corrections = {}
+        for ichannel, phase, residual in self.table:
+            corrections.setdefault(self.nslc_ids[ichannel], {})[str(phase)] = \
+                None if num.isnan(residual) else float(residual)
+        return corrections
 
+def load_station_corrections(fn, combine_channels=True, method='mean'):
+    """
+    :param combine_channels: if True, return one correction per station, which is the
+                             mean (or median, see *method*) of all phases and channels
+    :returns: dict NSL id -> correction, or NSLC id -> phase -> residual if
+              not *combine_channels*. See :py:class:`StationCorrections`
+              for the table these are derived from."""
+    corrections = StationCorrections.load(fn)
     if combine_channels:
-        combined = {}
-        for nslc_id, phasename_residual in corrections.items():
-            d = num.array(phasename_residual.values())
-            d = d[d!=num.array(None)]
-            combined[nslc_id[:3]] = num.mean(d)
-        return combined
+        return corrections.aggregate('station', method)
     else:
-        return corrections
+        return corrections.as_dict()
 
 class Reader:
     def __init__(self, basepath, data, events, phases, need_traces=None, event_sorting=None,
                  traces_blacklist=None, flip_polarities=None, 
-                 taper=None, gain=None, station_corrections=None, filter=None, exclude=None):
+                 taper=None, gain=None, station_corrections=None, filter=None, exclude=None,
+                 streaming=False, phase_tolerance=1e-3, cache_dir=None,
+                 window_cache=None):
+        """
+        :param station_corrections: :py:class:`StationCorrections` or dict of
+                                    time shifts per NSL id
+        :param streaming: parse events and phase markers one by one and only
+                          keep the events within the time range of the data
+                          and the phases assigned to them.
+        :param phase_tolerance: maximum difference between the event time of
+                                a phase marker and the time of the event it
+                                is assigned to [s]
+        :param cache_dir: directory of the pile's file index. Files whose
+                          modification time and size did not change are
+                          not scanned again on later runs. Default: the
+                          pyrocko cache directory.
+        :param window_cache: :py:class:`wavecache.WindowCache` keeping the
+                             raw waveforms of events, so that repeated
+                             calls of :py:meth:`get_waveforms` with other
+                             *left_shift* or conditioning do not read the
+                             archive again.
+        """
+        self._phase_tolerance = phase_tolerance
+        self._cache_dir = cache_dir
+        self._window_cache = window_cache
+        self._streaming = streaming
         self._need_traces = need_traces or 0
         self._station_corrections = station_corrections or {}
         self._gain = gain or {}
@@ -59,38 +198,119 @@ class Reader:
         if isinstance(data, list):
             self._data_paths = [pjoin(self._base_path, p) for p in data]
         else:
-            self._data_paths = pjoin(self._base_path, data)
+            self._data_paths = [pjoin(self._base_path, data)]
         self._event_sorting = event_sorting
+        self._selection = None
+        self.recorder = Recorder()
 
         self.log()
 
     def start(self):
-        self.events = model.load_events(self._meta_events)
-        if self._filter:
-            self.events = filter(self._filter, self.events)
-        for i in range(len(self.events)):
-            e = self.events[i]
-            if e.magnitude is None and e.moment_tensor is not None:
-                e.magnitude = e.moment_tensor.magnitude
-        if self._event_sorting is not None:
-            self.events.sort(key=self._event_sorting)
-        
-        if self._meta_phases:
-            self.phases = gui_util.PhaseMarker.load_markers(self._meta_phases)
-        else:
-            self.phases = []
-        self.assign_events()
+        with self.recorder.stage('reader.start') as record:
+            if self._streaming:
+                self.make_pile()
+                self.events = list(self.iter_catalog(self.pile.tmin,
+                                                     self.pile.tmax))
+                if self._event_sorting is not None:
+                    self.events.sort(key=self._event_sorting)
+                self.phases = []
+                if self._meta_phases:
+                    self.assign_events(iter_markers(self._meta_phases))
+                else:
+                    self.assign_events([])
+            else:
+                self.events = list(self.iter_catalog())
+                if self._event_sorting is not None:
+                    self.events.sort(key=self._event_sorting)
+                
+                if self._meta_phases:
+                    self.phases = gui_util.PhaseMarker.load_markers(self._meta_phases)
+                else:
+                    self.phases = []
+                self.assign_events()
+                self.make_pile()
+                self.clear_events()
+
+            self.make_index()
+            record['nevents'] = len(self.events)
+            record['nfiles'] = self._nfiles
+
+    def make_pile(self):
         data_paths = []
         for p in self._data_paths:
             data_paths.extend(glob.glob(p))
 
-        self.pile = pile.make_pile(data_paths)
-        self.clear_events()
+        kwargs = {}
+        if self._cache_dir is not None:
+            kwargs['cachedirname'] = self._cache_dir
+        self.pile = pile.make_pile(data_paths, **kwargs)
+        self._nfiles = len(data_paths)
+
+    def iter_catalog(self, tmin=None, tmax=None):
+        """Generator parsing the events file, yielding the events which pass
+        the filter and lie within *tmin* and *tmax* (exclusive)."""
+        for e in model.Event.load_catalog(self._meta_events):
+            if tmin is not None and not e.time>tmin:
+                continue
+            if tmax is not None and not e.time<tmax:
+                continue
+            if self._filter and not self._filter(e):
+                continue
+            if e.magnitude is None and e.moment_tensor is not None:
+                e.magnitude = e.moment_tensor.magnitude
+            yield e
+
+    def make_index(self):
+        """Hashed lookups for the per trace checks in :py:meth:`get_waveforms`"""
+        self._blacklist_index = set(as_nslc_ids(self._traces_blacklist,
+                                                'traces_blacklist'))
+        self._flip_index = set(as_nslc_ids(self._flip_polarities,
+                                           'flip_polarities'))
+        self._gain_index = dict(self._gain)
+        self._exclude_index = dict(self._exclude)
+        if isinstance(self._station_corrections, StationCorrections):
+            self._corrections_index = self._station_corrections.lookup()
+        else:
+            self._corrections_index = dict(self._station_corrections)
+        # gain and polarity merged into one factor per channel
+        self._scale_index = {}
+        for nslc_id in set(self._gain_index.keys()) | self._flip_index:
+            scale = self._gain_index.get(nslc_id, 1.)
+            if nslc_id in self._flip_index:
+                scale *= -1.
+            self._scale_index[nslc_id] = scale
+
+    def set_station_selection(self, stations, dist_min, dist_max):
+        """Only retrieve waveforms of *stations* within a distance range of
+        the event.
+
+        :param stations: list of :py:class:`pyrocko.model.Station`
+        :param dist_min: minimum epicentral distance [m]
+        :param dist_max: maximum epicentral distance [m]
+        """
+        self._selection = (
+            [s.nsl() for s in stations],
+            num.array([s.lat for s in stations], dtype=num.float64),
+            num.array([s.lon for s in stations], dtype=num.float64),
+            dist_min, dist_max)
+
+    def get_selected_stations(self, event):
+        """Set of NSL ids of the stations selected for *event* or None if
+        no selection is set"""
+        if self._selection is None:
+            return None
+        nsls, lats, lons, dist_min, dist_max = self._selection
+        dists = orthodrome.distance_accurate50m_numpy(
+            num.ones(lats.size)*event.lat, num.ones(lons.size)*event.lon,
+            lats, lons)
+        iselected = num.where(num.logical_and(dists>=dist_min,
+                                              dists<=dist_max))[0]
+        return set(nsls[i] for i in iselected)
 
     def clear_events(self):
         """remove all events which are out of the piles scope"""
-        self.events = filter(lambda e: e.time>self.pile.tmin and
-                             e.time<self.pile.tmax, self.events)
+        self.events = [e for e in self.events
+                       if e.time>self.pile.tmin and e.time<self.pile.tmax]
 
     def iter_events_and_markers(self):
         for e in self.iter_events():
@@ -100,72 +320,242 @@ class Reader:
         for e in self.events:
             yield e
 
-    def assign_events(self):
-        # doesn't work: probably an error when assigning hashes at write time
-        #hashs = {}
-        #for e in self.iter_events():
-        #    hashs[e.get_hash()] = e
-        events_by_time = {}
-        for e in self.iter_events():
-            events_by_time[e.time] = e
-        i_unassigned = 0
-        i_assigned = 0
+    def assign_events(self, markers=None, chunksize=100000):
+        """Assign phase markers to the event closest in time to the marker's
+        event time, if within the phase tolerance.
+
+        Markers are matched in chunks against a sorted array of event times.
+
+        :param markers: iterable of phase markers (default: self.phases)
+        :param chunksize: number of markers matched at once
+        """
+        if markers is None:
+            markers = self.phases
+        events = sorted(self.events, key=lambda e: e.time)
+        times = num.array([e.time for e in events], dtype=num.float64)
         self._phases = defaultdict(list)
-        for p in self.phases:
-            try:
-                event_identifier = p.get_event_time()
-                p.set_event(events_by_time[event_identifier])
-                p.tmin -= p.get_event().time
-                p.tmax -= p.get_event().time
-                self._phases[event_identifier].append(p)
-                i_assigned += 1
-            except KeyError:
-                logger.debug('could not set event for phase %s'%p)
-                i_unassigned += 1
-                pass
-
-        logger.info('unassigned/assigned: %s/%s '%(i_unassigned, i_assigned))
+        self.n_assigned = 0
+        self.n_unassigned = 0
+        chunk = []
+        for p in markers:
+            chunk.append(p)
+            if len(chunk) >= chunksize:
+                self._assign_chunk(chunk, events, times)
+                chunk = []
+        if chunk:
+            self._assign_chunk(chunk, events, times)
 
-    def get_waveforms(self, event, timespan=20., reset_time=False, left_shift=None):
-        '''request waveforms and equilibrate sampling rates if needed
-        
-        :param reset_time: if True subtract event time
-        :param left_shift: 0.-1. if 1:shift targeted time window 100% of window length left'''
-        traces = []
+        logger.info('unassigned/assigned: %s/%s '%(self.n_unassigned, self.n_assigned))
+
+    def _assign_chunk(self, markers, events, times):
+        marker_times = num.array(
+            [num.nan if p.get_event_time() is None else p.get_event_time()
+             for p in markers], dtype=num.float64)
+        if times.size == 0:
+            self.n_unassigned += len(markers)
+            return
+
+        # nearest event time, nan sorts behind all events
+        iright = num.clip(num.searchsorted(times, marker_times), 0, times.size-1)
+        ileft = num.clip(iright-1, 0, times.size-1)
+        dleft = num.abs(times[ileft] - marker_times)
+        dright = num.abs(times[iright] - marker_times)
+        inearest = num.where(dright < dleft, iright, ileft)
+        with num.errstate(invalid='ignore'):
+            matched = num.minimum(dleft, dright) <= self._phase_tolerance
+
+        for imarker in num.where(matched)[0]:
+            p = markers[imarker]
+            e = events[inearest[imarker]]
+            p.set_event(e)
+            p.tmin -= e.time
+            p.tmax -= e.time
+            self._phases[e.time].append(p)
+
+        nmatched = int(num.sum(matched))
+        self.n_assigned += nmatched
+        self.n_unassigned += len(markers) - nmatched
+
+    def get_time_window(self, event, timespan=20., left_shift=None):
+        '''time window of *event* as (tmin, tmax)'''
         if left_shift:
             tshift = timespan*left_shift
         else:
             tshift = 0.
-        for traces_segment in self.pile.chopper(event.time-tshift, event.time+timespan-tshift):
-            for tr in traces_segment:
-                if tr.nslc_id in self._traces_blacklist:
-                    continue
-                if reset_time:
-                    tr.shift(-event.time)
-                if tr.nslc_id in self._flip_polarities:
-                    tr.set_ydata(tr.get_ydata()*-1)
-                
-                if tr.nslc_id in self._gain.keys():
-                    tr.set_ydata(tr.get_ydata()*self._gain[tr.nslc_id])
-                
-                if tr.nslc_id[:3] in self._station_corrections.keys():
-                    tr.shift(self._station_corrections[tr.nslc_id[:3]])
-                if tr.nslc_id in self._exclude.keys():
-                    tmin, tmax = self._exclude[tr.nslc_id]
-                    if event.time >= tmin and event.time<=tmax:
-                        continue 
+        return event.time-tshift, event.time+timespan-tshift
+
+    def get_selectors(self, event):
+        '''group and trace selector for the pile chopper'''
+        selected = self.get_selected_stations(event)
+        if selected is None:
+            group_selector = None
+            trace_selector = lambda tr: tr.nslc_id not in self._blacklist_index
+        else:
+            selected_stations = set(nsl[1] for nsl in selected)
+            group_selector = lambda gr: any(
+                s in gr.stations for s in selected_stations)
+            trace_selector = lambda tr: tr.nslc_id[:3] in selected and \
+                tr.nslc_id not in self._blacklist_index
+        return group_selector, trace_selector
+
+    def condition_traces(self, traces, event, reset_time=False):
+        '''apply exclusions, time reset, polarity flips, gains, station
+        corrections and taper.
+
+        Samples are modified in place. Traces are given their own float copy
+        of the samples first if they are about to be modified, since chopped
+        traces may share their samples with the pile or other traces.'''
+        conditioned = []
+        for tr in traces:
+            if tr.nslc_id in self._exclude_index:
+                tmin, tmax = self._exclude_index[tr.nslc_id]
+                if event.time >= tmin and event.time<=tmax:
+                    continue 
+
+            if reset_time:
+                tr.shift(-event.time)
 
+            scale = self._scale_index.get(tr.nslc_id, None)
+            if scale is not None or self._taper:
+                own_float_data(tr)
+            if scale is not None:
+                ydata = tr.get_ydata()
+                ydata *= scale
+            
+            if tr.nslc_id[:3] in self._corrections_index:
+                tr.shift(self._corrections_index[tr.nslc_id[:3]])
 
-                if self._taper:
-                    tr.taper(self._taper)
+            conditioned.append(tr)
 
-                traces.append(tr)
+        if self._taper:
+            self.taper_traces(conditioned)
+
+        return conditioned
+
+    def taper_traces(self, traces):
+        '''Taper in place. The taper window is evaluated once per group of
+        traces sharing sampling interval and length (and start time, unless
+        the taper is a :py:class:`pyrocko.trace.CosFader`, which only
+        depends on the trace extent).'''
+        relative = isinstance(self._taper, trace.CosFader)
+        windows = {}
+        for tr in traces:
+            ydata = tr.get_ydata()
+            key = (tr.deltat, ydata.size, None if relative else tr.tmin)
+            if key not in windows:
+                window = num.ones(ydata.size, dtype=num.float64)
+                self._taper(window, tr.tmin, tr.deltat)
+                windows[key] = window
+            ydata *= windows[key]
+
+    def get_waveforms(self, event, timespan=20., reset_time=False, left_shift=None):
+        '''request waveforms and equilibrate sampling rates if needed
         
+        :param reset_time: if True subtract event time
+        :param left_shift: 0.-1. if 1:shift targeted time window 100% of window length left'''
+        tmin, tmax = self.get_time_window(event, timespan, left_shift)
+        group_selector, trace_selector = self.get_selectors(event)
+        ptmin, ptmax = self.get_time_window(event, 2.*timespan, 0.5)
+        if self._window_cache is not None and ptmin <= tmin and tmax <= ptmax:
+            traces = self.cut_windows(
+                self.get_cached_window(event, ptmin, ptmax),
+                trace_selector, tmin, tmax)
+        else:
+            traces = []
+            for traces_segment in self.pile.chopper(
+                    tmin, tmax, group_selector=group_selector,
+                    trace_selector=trace_selector):
+                traces.extend(traces_segment)
+        
+        return self.condition_traces(traces, event, reset_time)
+
+    def get_cached_window(self, event, tmin, tmax):
+        '''raw traces of all channels between *tmin* and *tmax* from the
+        window cache, chopped from the pile on a miss. The returned traces
+        must not be modified.'''
+        key = self._window_cache.make_key(event, tmin, tmax)
+        traces = self._window_cache.get(key)
+        if traces is None:
+            # all channels, the blacklist is applied when cutting, since it
+            # is not part of the key
+            traces = []
+            for traces_segment in self.pile.chopper(tmin, tmax):
+                traces.extend(traces_segment)
+            self._window_cache.put(key, traces)
         return traces
 
+    def cut_windows(self, traces, trace_selector, tmin, tmax):
+        '''copies of the selected *traces* cut to *tmin*, *tmax*. The copies
+        share their samples with *traces*.'''
+        cut = []
+        for tr in traces:
+            if not trace_selector(tr):
+                continue
+            try:
+                cut.append(tr.chop(tmin, tmax, inplace=False))
+            except trace.NoData:
+                continue
+        return cut
+
+    def get_waveforms_batch(self, events, timespan=20., reset_time=False,
+                            left_shift=None, memory_budget=500e6):
+        '''Generator yielding (event, traces) for many events with a single
+        pass over the pile.
+
+        Events are processed in chronological order. Events whose time
+        windows are close to each other are grouped and their common time
+        span is chopped once. The span of a group is limited such that the
+        estimated size of the loaded samples stays below *memory_budget*.
+
+        :param memory_budget: approximate limit of loaded data [bytes]
+        See :py:meth:`get_waveforms` for the other parameters.'''
+        events = sorted(events, key=lambda e: e.time)
+        max_span = memory_budget / self.get_bytes_per_second()
+        group = []
+        for e in events:
+            tmin, tmax = self.get_time_window(e, timespan, left_shift)
+            if group and (tmin - group_tmax > timespan or
+                          tmax - group_tmin > max_span):
+                for item in self._chop_group(group, timespan, reset_time,
+                                             left_shift):
+                    yield item
+                group = []
+
+            if not group:
+                group_tmin, group_tmax = tmin, tmax
+            group.append(e)
+            group_tmax = max(group_tmax, tmax)
+
+        if group:
+            for item in self._chop_group(group, timespan, reset_time,
+                                         left_shift):
+                yield item
+
+    def get_bytes_per_second(self):
+        '''estimated size of one second of data of all channels in the pile
+        as 8 byte samples'''
+        return len(self.pile.nslc_ids) * 8. / min(self.pile.deltats.keys())
+
+    def _chop_group(self, events, timespan, reset_time, left_shift):
+        windows = [self.get_time_window(e, timespan, left_shift) for e in events]
+        tmin = min(w[0] for w in windows)
+        tmax = max(w[1] for w in windows)
+        logger.debug('chopping %s events between %s and %s' % (
+            len(events), util.time_to_str(tmin), util.time_to_str(tmax)))
+        group_traces = []
+        for traces_segment in self.pile.chopper(
+                tmin, tmax,
+                trace_selector=lambda tr: tr.nslc_id not in self._blacklist_index):
+            group_traces.extend(traces_segment)
+
+        for e, (wmin, wmax) in zip(events, windows):
+            traces = self.cut_windows(group_traces, self.get_selectors(e)[1],
+                                      wmin, wmax)
+            yield e, self.condition_traces(traces, e, reset_time)
+
     def get_phases_of_event(self, event):
         return self._phases[event.time]
     
     def log(self):
-        for k,v in self.__dict__.iteritems():
+        for k,v in self.__dict__.items():
             logger.info("%s: %s" % (k,v))
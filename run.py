@@ -2,8 +2,9 @@
 import logging
 import os
 import sys
-from reader import Reader, load_station_corrections
+from reader import Reader, StationCorrections
 from rapidizer import RapidinvConfig, MultiEventInversion, FancyFilter
+from wavecache import WindowCache
 from pyrocko.trace import CosFader
 from pyrocko import util
 from wrapid_logging import setup_logger
@@ -40,11 +41,11 @@ if __name__ == '__main__':
                         #('', 'KRC', '', 'SHN'),
                         #('', 'KRC', '', 'SHE'),]
     gain = {('','STC','','SHE'):0.4, ('','STC','','SHN'):0.4, ('','STC','','SHZ'):0.4}
-    station_corrections = load_station_corrections('/home/marius/src/seismerize/residuals_median_CakeResiduals.dat')
+    station_corrections = StationCorrections.load('/home/marius/src/seismerize/residuals_median_CakeResiduals.dat')
     #station_corrections = None
     taper = CosFader(xfade=3.)
     flip_polarities=[('','VAC','','SHE'),
-                    ('', 'SKC','','SHE')],
+                    ('', 'SKC','','SHE')]
     
     exclude = {('','VAC','','SHN'):[0., util.str_to_time('2008-10-09 13:49:00.0')]}
 
@@ -66,7 +67,9 @@ if __name__ == '__main__':
                gain=gain, 
                station_corrections=station_corrections, 
                exclude=exclude,
-               filter=lambda x: x.magnitude<2.0)
+               filter=lambda x: x.magnitude<2.0,
+               cache_dir=pjoin(webnet, 'pile_cache'),
+               window_cache=WindowCache(pjoin(webnet, 'window_cache')))
     r.start()
 
     magnitudes = [-1., 1, 2, 3, 4]
@@ -0,0 +1,183 @@
+"""Task queue on a shared file system.
+
+A queue is a directory with the subdirectories *pending*, *claimed* and
+*done*, holding one json file per task. Workers claim a task by renaming
+its file from *pending* to *claimed*, which succeeds for exactly one of
+them. While a task runs, its worker touches the claimed file regularly;
+tasks whose file has not been touched for *stale_after* seconds are
+considered lost with their worker and moved back to *pending*.
+"""
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from os.path import join as pjoin
+
+logger = logging.getLogger('wrapidinv')
+
+def _write_json(fn, data):
+    fn_tmp = '%s.%s.%i.tmp' % (fn, socket.gethostname(), os.getpid())
+    with open(fn_tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(fn_tmp, fn)
+
+def _read_json(fn):
+    with open(fn, 'r') as f:
+        return json.load(f)
+
+class Task():
+    def __init__(self, task_id, payload, fn):
+        self.task_id = task_id
+        self.payload = payload
+        self.fn = fn
+
+    def __str__(self):
+        return self.task_id
+
+class TaskQueue():
+    """
+    :param directory: queue directory, created if needed
+    :param stale_after: seconds without heartbeat after which a claimed
+        task is handed out again
+    """
+    def __init__(self, directory, stale_after=300.):
+        self.directory = directory
+        self.stale_after = stale_after
+        for state in ['pending', 'claimed', 'done']:
+            try:
+                os.makedirs(self.path(state))
+            except OSError:
+                if not os.path.isdir(self.path(state)):
+                    raise
+
+    def path(self, state, task_id=None):
+        if task_id is None:
+            return pjoin(self.directory, state)
+        return pjoin(self.directory, state, task_id + '.json')
+
+    def list(self, state):
+        """Sorted ids of the tasks in *state*"""
+        return sorted(fn[:-5] for fn in os.listdir(self.path(state))
+                      if fn.endswith('.json'))
+
+    def reset(self):
+        """Remove all tasks."""
+        for state in ['pending', 'claimed', 'done']:
+            for fn in os.listdir(self.path(state)):
+                os.remove(pjoin(self.path(state), fn))
+
+    def put(self, task_id, payload):
+        """Publish a task. Tasks are claimed in the order of their ids."""
+        _write_json(self.path('pending', task_id), payload)
+
+    def claim(self):
+        """Claim the next pending task.
+
+        :returns: :py:class:`Task` or None if no task is pending"""
+        for task_id in self.list('pending'):
+            fn_pending = self.path('pending', task_id)
+            fn = self.path('claimed', task_id)
+            try:
+                # the modification time is kept by the rename and has to be
+                # the claim time when the file shows up in claimed/,
+                # otherwise reclaim_stale could take it back at once
+                os.utime(fn_pending, None)
+                os.rename(fn_pending, fn)
+                payload = _read_json(fn)
+            except (IOError, OSError):
+                # claimed by another worker in the meantime, or reclaimed
+                continue
+            return Task(task_id, payload, fn)
+        return None
+
+    def heartbeat(self, fn):
+        try:
+            os.utime(fn, None)
+        except OSError:
+            pass
+
+    def complete(self, task, result):
+        """Store the *result* dict of a claimed task."""
+        _write_json(self.path('done', task.task_id),
+                    {'payload': task.payload, 'result': result})
+        try:
+            os.remove(task.fn)
+        except OSError:
+            # reclaimed after a missed heartbeat
+            pass
+
+    def get_result(self, task_id):
+        return _read_json(self.path('done', task_id))['result']
+
+    def reclaim_stale(self):
+        """Move tasks without recent heartbeat back to *pending*.
+
+        :returns: number of reclaimed tasks"""
+        n = 0
+        now = time.time()
+        for task_id in self.list('claimed'):
+            fn = self.path('claimed', task_id)
+            try:
+                if now - os.path.getmtime(fn) < self.stale_after:
+                    continue
+                os.rename(fn, self.path('pending', task_id))
+            except OSError:
+                continue
+            logger.warning('reclaimed stale task %s' % task_id)
+            n += 1
+        return n
+
+    def is_drained(self):
+        return not self.list('pending') and not self.list('claimed')
+
+class Heartbeat(threading.Thread):
+    """Touches the file of a running task every *interval* seconds."""
+    def __init__(self, queue, task, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.task = task
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.queue.heartbeat(self.task.fn)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def run_worker(queue, func, worker_id=None, poll=1., heartbeat=30.,
+               exit_when_drained=False):
+    """Claim and run tasks until stopped.
+
+    :param queue: :py:class:`TaskQueue`
+    :param func: called with the payload of a task, returns a json
+        serializable result
+    :param exit_when_drained: return when no task is pending or claimed
+    :returns: number of tasks run
+    """
+    worker_id = worker_id or '%s.%i' % (socket.gethostname(), os.getpid())
+    ntasks = 0
+    while True:
+        task = queue.claim()
+        if task is None:
+            queue.reclaim_stale()
+            if exit_when_drained and queue.is_drained():
+                return ntasks
+            time.sleep(poll)
+            continue
+
+        logger.info('worker %s runs task %s' % (worker_id, task))
+        beat = Heartbeat(queue, task, heartbeat)
+        beat.start()
+        try:
+            result = func(task.payload)
+        finally:
+            beat.stop()
+        result['worker'] = worker_id
+        queue.complete(task, result)
+        ntasks += 1
@@ -0,0 +1,30 @@
+import csv
+
+from pyrocko import model
+
+from harvest import Harvester
+
+def test_harvester_replaces_result_of_changed_input(tmpdir):
+    fn_table = str(tmpdir.join('results.csv'))
+    fn_events = str(tmpdir.join('results.pf'))
+    e = model.Event(lat=50., lon=12., time=1199145600., depth=8000.,
+                    name='ev')
+    result = {'misfit': '0.3', 'depth': '7.5', 'strike': '30', 'dip': '60',
+              'rake': '-90', 'moment': '1e12'}
+
+    harvester = Harvester(fn_table, fn_events)
+    assert harvester.add('ev', e, result, 'a')
+    assert harvester.add('ev2', e, result, 'a')
+    harvester.save_events()
+
+    harvester = Harvester(fn_table, fn_events)
+    assert not harvester.add('ev', e, result, 'a')
+    assert harvester.add('ev', e, dict(result, depth='9.5'), 'b')
+    harvester.save_events()
+
+    with open(fn_table, 'r') as f:
+        rows = list(csv.DictReader(f))
+    assert [(row['key'], row['depth'], row['input_hash']) for row in rows] \
+        == [('ev2', '7.5', 'a'), ('ev', '9.5', 'b')]
+    depths = dict((ev.name, ev.depth) for ev in model.load_events(fn_events))
+    assert depths == {'ev': 9500., 'ev2': 7500.}
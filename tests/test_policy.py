@@ -0,0 +1,17 @@
+import time
+
+import rapidizer
+from rapidizer import TaskPolicy
+
+def test_timed_out_attempts_are_killed_and_retried(tmpdir, monkeypatch):
+    fn_input = tmpdir.join('rapid.inp')
+    fn_input.write('DATA_DIR %s\n' % tmpdir)
+    monkeypatch.setattr(rapidizer, 'run_rapidinv',
+                        lambda args: time.sleep(60.))
+
+    policy = TaskPolicy(timeout=0.5, retries=1)
+    t0 = time.time()
+    result = policy((str(fn_input), str(tmpdir.join('rapid.log'))))
+    assert result.status == 'timeout'
+    assert result.attempts == policy.retries + 1
+    assert time.time() - t0 < 10.
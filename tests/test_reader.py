@@ -0,0 +1,38 @@
+from pyrocko import gui_util, model
+
+from reader import Reader, iter_markers
+from benchmark.synthetic import SyntheticSetup
+
+def test_iter_markers_reads_saved_phase_markers(tmpdir):
+    e = model.Event(lat=50., lon=12., time=1199145600., name='ev')
+    phases = [gui_util.PhaseMarker([('XX', 'STA%i' % i, '', 'SHZ')],
+                                   e.time + i, e.time + i, kind=0, event=e,
+                                   phasename='P')
+              for i in range(3)]
+    fn = str(tmpdir.join('markers.pf'))
+    gui_util.save_markers(phases + [gui_util.EventMarker(e)], fn)
+
+    markers = list(iter_markers(fn))
+    assert [m.get_phasename() for m in markers] == ['P']*3
+    assert [tuple(m.nslc_ids) for m in markers] == \
+        [tuple(p.nslc_ids) for p in phases]
+    assert [m.tmin for m in markers] == [p.tmin for p in phases]
+    assert all(m.get_event_time() == e.time for m in markers)
+
+def test_streaming_reader_assigns_same_phases(tmpdir):
+    setup = SyntheticSetup(str(tmpdir), nevents=5, nstations=3)
+    setup.make()
+
+    def phases_by_event(streaming):
+        reader = Reader(setup.directory, data='data/*', events='events.pf',
+                        phases='phases.pf', streaming=streaming)
+        reader.start()
+        return dict(
+            (e.name, sorted((tuple(p.nslc_ids), p.tmin, p.get_phasename())
+                            for p in reader.get_phases_of_event(e)))
+            for e in reader.events)
+
+    streamed = phases_by_event(True)
+    assert streamed
+    assert all(streamed.values())
+    assert streamed == phases_by_event(False)
@@ -0,0 +1,58 @@
+import os
+import time
+from multiprocessing import Pool
+
+from taskqueue import TaskQueue
+
+def claim_all(directory):
+    queue = TaskQueue(directory)
+    claimed = []
+    while True:
+        task = queue.claim()
+        if task is None:
+            return claimed
+        claimed.append(task.task_id)
+
+def test_task_is_claimed_once(tmpdir):
+    directory = str(tmpdir.join('queue'))
+    queue = TaskQueue(directory)
+    queue.put('000000_ev', {'args': ['rapid.inp']})
+
+    task = queue.claim()
+    assert task.task_id == '000000_ev'
+    assert task.payload == {'args': ['rapid.inp']}
+    assert TaskQueue(directory).claim() is None
+    assert queue.list('claimed') == ['000000_ev']
+
+def test_concurrent_claimers_claim_each_task_once(tmpdir):
+    directory = str(tmpdir.join('queue'))
+    queue = TaskQueue(directory)
+    task_ids = ['%06i_ev' % i for i in range(200)]
+    for task_id in task_ids:
+        queue.put(task_id, {})
+
+    pool = Pool(4)
+    try:
+        claimed = pool.map(claim_all, [directory]*4)
+    finally:
+        pool.terminate()
+        pool.join()
+    claimed = [task_id for ids in claimed for task_id in ids]
+    assert sorted(claimed) == task_ids
+
+def test_reclaim_stale(tmpdir):
+    queue = TaskQueue(str(tmpdir.join('queue')), stale_after=60.)
+    queue.put('000000_ev', {})
+    queue.put('000001_ev', {})
+    stale = queue.claim()
+    fresh = queue.claim()
+    t = time.time() - 61.
+    os.utime(stale.fn, (t, t))
+
+    assert queue.reclaim_stale() == 1
+    assert queue.list('pending') == [stale.task_id]
+    assert queue.list('claimed') == [fresh.task_id]
+
+    # the worker of the stale task finishing late does not fail
+    queue.complete(stale, {'status': 'ok'})
+    assert queue.get_result(stale.task_id) == {'status': 'ok'}
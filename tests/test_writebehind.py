@@ -0,0 +1,31 @@
+import threading
+
+import pytest
+
+from writebehind import WriteBehind, WriteError
+
+def test_flush_raises_write_error_of_key():
+    writer = WriteBehind(nthreads=2, max_pending=4)
+    written = []
+
+    def fail():
+        raise IOError('disk full')
+
+    writer.submit('bad', fail)
+    writer.submit('good', written.append, 'good')
+    with pytest.raises(WriteError) as excinfo:
+        writer.flush('bad')
+    assert 'disk full' in str(excinfo.value)
+    writer.flush('good')
+    assert written == ['good']
+    # errors are reported once
+    writer.flush()
+
+def test_flush_waits_for_pending_jobs():
+    writer = WriteBehind(nthreads=1, max_pending=2)
+    release = threading.Event()
+    writer.submit('ev', release.wait)
+    assert not writer.is_done('ev')
+    release.set()
+    writer.flush('ev')
+    assert writer.is_done('ev')
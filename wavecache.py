@@ -0,0 +1,119 @@
+"""LRU cache of raw waveform windows, kept in memory and on disk.
+
+Entries are lists of traces as chopped from the pile, before any
+conditioning. On disk every entry is a trace bundle (see :py:mod:`bundle`)
+named by the hash of its key. The cache does not notice changes of the
+waveform archive; remove the cache directory after modifying it.
+"""
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+from os.path import join as pjoin
+
+from bundle import write_bundle, load_bundle
+
+logger = logging.getLogger('wrapidinv')
+
+def traces_size(traces):
+    return sum(tr.get_ydata().nbytes for tr in traces)
+
+class WindowCache():
+    """
+    :param cache_dir: directory of the disk cache, None to keep entries in
+        memory only
+    :param memory_size: limit of the samples held in memory [bytes]
+    :param disk_size: limit of the disk cache [bytes]
+    """
+    def __init__(self, cache_dir=None, memory_size=200e6, disk_size=5e9):
+        self.cache_dir = cache_dir
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk = OrderedDict()
+        self._disk_used = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            self.scan_disk()
+
+    def scan_disk(self):
+        """Index the disk cache, least recently used first."""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith('.bundle'):
+                continue
+            stat = os.stat(pjoin(self.cache_dir, fn))
+            entries.append((stat.st_mtime, fn[:-7], stat.st_size))
+        for mtime, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_used += size
+
+    @staticmethod
+    def make_key(event, tmin, tmax):
+        return hashlib.md5(('%s %.6f %.6f %.6f' % (
+            event.name, event.time, tmin, tmax)).encode('utf-8')).hexdigest()
+
+    def get_filename(self, key):
+        return pjoin(self.cache_dir, key + '.bundle')
+
+    def get(self, key):
+        """Traces of *key* or None. The traces must not be modified."""
+        if key in self._memory:
+            traces = self._memory.pop(key)
+            self._memory[key] = traces
+            self.hits += 1
+            return traces
+
+        if key in self._disk:
+            fn = self.get_filename(key)
+            try:
+                traces = load_bundle(fn)[0]
+                os.utime(fn, None)
+            except (IOError, OSError, ValueError):
+                logger.warning('dropping unreadable cache entry %s' % fn)
+                self._remove_disk(key)
+            else:
+                self._disk[key] = self._disk.pop(key)
+                self._put_memory(key, traces)
+                self.disk_hits += 1
+                return traces
+
+        self.misses += 1
+        return None
+
+    def put(self, key, traces):
+        self._put_memory(key, traces)
+        if self.cache_dir is not None and key not in self._disk:
+            fn = self.get_filename(key)
+            write_bundle(fn, traces)
+            self._disk[key] = os.path.getsize(fn)
+            self._disk_used += self._disk[key]
+            while self._disk_used > self.disk_size and len(self._disk) > 1:
+                self._remove_disk(next(iter(self._disk)))
+
+    def _put_memory(self, key, traces):
+        if key in self._memory:
+            self._memory_used -= traces_size(self._memory.pop(key))
+        self._memory[key] = traces
+        self._memory_used += traces_size(traces)
+        while self._memory_used > self.memory_size and len(self._memory) > 1:
+            self._memory_used -= traces_size(self._memory.popitem(last=False)[1])
+
+    def _remove_disk(self, key):
+        self._disk_used -= self._disk.pop(key)
+        try:
+            os.remove(self.get_filename(key))
+        except OSError:
+            pass
+
+    def stats(self):
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_used': self._memory_used,
+                'disk_used': self._disk_used}
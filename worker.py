@@ -0,0 +1,48 @@
+#/usr/bin/env python
+"""Worker daemon running the inversions published to a task queue by
+MultiEventInversion.run_distributed. Start one per host (or several) on
+machines which see the queue and the inversion directories under the same
+paths::
+
+    python worker.py /path/to/base_path/queue --timeout 3600
+
+Retries and retry overrides published with a task take precedence over
+--retries and --retry-override.
+"""
+import argparse
+import logging
+from rapidizer import TaskPolicy, queue_worker
+from wrapid_logging import setup_logger
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('queue_dir')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='wall clock limit per inversion [s]')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='address space limit per inversion [bytes]')
+    parser.add_argument('--retries', type=int, default=0)
+    parser.add_argument('--retry-override', action='append', default=[],
+                        metavar='KEY=VALUE[,KEY=VALUE...]',
+                        help='rapidinv parameters replaced in the input of '
+                             'a retry. Given once per retry, the last one '
+                             'applies to further retries.')
+    parser.add_argument('--poll', type=float, default=5.,
+                        help='seconds between looking for new tasks')
+    parser.add_argument('--stale-after', type=float, default=300.,
+                        help='seconds without heartbeat until the task of '
+                             'a dead worker is run again')
+    parser.add_argument('--exit-when-drained', action='store_true',
+                        help='stop when the queue is empty')
+    args = parser.parse_args()
+
+    setup_logger('wrapidinv', None, level=logging.INFO)
+    setup_logger('rapidinv', None)
+    memory_limit = args.memory_limit and int(args.memory_limit)
+    retry_overrides = [dict(item.split('=', 1) for item in o.split(','))
+                       for o in args.retry_override]
+    policy = TaskPolicy(timeout=args.timeout, memory_limit=memory_limit,
+                        retries=args.retries, retry_overrides=retry_overrides)
+    queue_worker(args.queue_dir, policy, stale_after=args.stale_after,
+                 poll=args.poll, heartbeat=min(30., args.stale_after/4.),
+                 exit_when_drained=args.exit_when_drained)
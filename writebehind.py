@@ -0,0 +1,103 @@
+"""Write-behind stage: file writing jobs run in a pool of threads, so that
+the preparation of the next event does not wait for the file system."""
+import os
+import logging
+import threading
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger('wrapidinv')
+
+class WriteError(Exception):
+    pass
+
+def fsync_paths(paths):
+    """fsync the files in *paths*, directories recursively"""
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                fsync_paths(os.path.join(dirpath, fn) for fn in filenames)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+class WriteBehind():
+    """Runs jobs in *nthreads* threads.
+
+    Jobs are grouped by a key, e.g. the inversion they belong to.
+    :py:meth:`submit` blocks while *max_pending* jobs are waiting, which
+    keeps the amount of data held in memory bounded.
+
+    :param fsync: fsync the paths returned by each job, so that they are
+        on disk (or on the file server) when :py:meth:`flush` returns
+    """
+    def __init__(self, nthreads=4, max_pending=16, fsync=False):
+        self.nthreads = nthreads
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self._queue = queue.Queue(max_pending)
+        self._pending = {}
+        self._errors = {}
+        self._condition = threading.Condition()
+        for i in range(nthreads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, key, func, *args):
+        """Queue ``func(*args)``. *func* may return a list of written paths
+        to be fsynced."""
+        with self._condition:
+            self._pending[key] = self._pending.get(key, 0) + 1
+        self._queue.put((key, func, args))
+
+    def _work(self):
+        while True:
+            key, func, args = self._queue.get()
+            error = None
+            try:
+                paths = func(*args)
+                if self.fsync and paths:
+                    fsync_paths(paths)
+            except Exception:
+                error = traceback.format_exc()
+
+            with self._condition:
+                self._pending[key] -= 1
+                if self._pending[key] == 0:
+                    del self._pending[key]
+                if error is not None:
+                    self._errors[key] = error
+                self._condition.notify_all()
+
+    def is_done(self, key):
+        with self._condition:
+            return key not in self._pending
+
+    def flush(self, key=None):
+        """Wait until the jobs of *key* (of all keys if None) are finished.
+
+        :raises: :py:exc:`WriteError` if one of them failed
+        """
+        with self._condition:
+            if key is None:
+                while self._pending:
+                    self._condition.wait()
+                errors = list(self._errors.items())
+                self._errors.clear()
+            else:
+                while key in self._pending:
+                    self._condition.wait()
+                errors = []
+                if key in self._errors:
+                    errors.append((key, self._errors.pop(key)))
+
+        if errors:
+            raise WriteError('\n'.join('writing %s failed:\n%s' % error
+                                       for error in errors))